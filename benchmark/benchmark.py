@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+benchmark for nft_geo_pvc, runs offline without nft
+
+generates synthetic db-ip lite csv databases (country, city and asn) and times the hot paths:
+  building the lookup index and filter caches, generate_sets() per filter type, write_set(),
+  parsing the written set file, reading its binary sidecar and query_host()
+every stage runs in its own process, so the reported peak memory belongs to that stage only
+
+example:
+   ./benchmark/benchmark.py
+        small databases (1/20 of the real size), generated once under /tmp/nft_geo_pvc_benchmark
+   ./benchmark/benchmark.py --size real --json results.json
+        databases of the size of the real lite databases, results also saved as json
+   ./benchmark/benchmark.py --size 10x --engine python --jobs 4
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import nft_geo_pvc
+
+# rows per database, roughly the size of the db-ip lite databases
+database_rows = {"country": 600_000, "city": 3_200_000, "asn": 500_000}
+sizes = {"small": 0.05, "real": 1, "10x": 10}
+# part of the rows that are ipv6
+ipv6_share = 0.25
+datum = "2000-01"
+
+# filter values that are guaranteed to be in the synthetic databases
+stage_filters = {
+    "filter-country": {"country": ["be"]},
+    "filter-continent": {"continent": ["eu"]},
+    "filter-region": {"region": ["region 7"]},
+    "filter-city": {"city": ["himeji"]},
+    "filter-asn": {"asn": ["24940"]},
+    "filter-as-name": {"asn": ["hetzner online gmbh"]},
+    "filter-custom-ips": {"custom_ips": ["1.1.1.1", "10.0.0.0/8", "192.168.0.1-192.168.3.255", "2a00::/16"]},
+    "filter-expression": {"filter": "continent=eu and not (country=be or asn=24940)"},
+}
+
+
+def database_names():
+    return {name: f"dbip-{name}-lite-{datum}.csv" for name in database_rows}
+
+
+def profile(work_dir, **options):
+    # the options generate_sets and write_set read, as set by the command line of nft_geo_pvc
+    profile = argparse.Namespace(asn=[], continent=[], country=[], region=[], city=[], custom_ips=[],
+                                 custom_ips_file=None, custom_hosts_file=None, filter=None, cidr=False, set_name="bench",
+                                 apply=False, config=None, quiet=True, database_path=str(work_dir), datum=datum,
+                                 engine="auto", jobs=1, result_cache_size=0,
+                                 target_file=str(Path(work_dir, "bench.nft")))
+    for option, value in options.items():
+        setattr(profile, option, value)
+    return profile
+
+
+def synthetic_ranges(family, rows, rng):
+    # consecutive ranges with random sizes spread over the public address space
+    if family == 4:
+        first, last = 1 << 24, 224 << 24
+    else:
+        first, last = 0x2001 << 112, 0x2c00 << 112
+    step = (last - first) // rows
+    start = first
+    for row in range(rows):
+        stop = start + rng.randrange(1, step * 2)
+        yield start, min(stop, last) - 1
+        start = stop
+        if start >= last:
+            return
+
+
+def generate_databases(work_dir, scale, seed):
+    rng = random.Random(seed)
+    countries = ["be"] + [f"{chr(97 + first)}{chr(97 + second)}" for first in range(26) for second in range(10)]
+    continents = ["eu", "as", "na", "sa", "af", "oc", "an"]
+    regions = [f"Region {number}" for number in range(4000)]
+    cities = [f"City {number}" for number in range(100_000)]
+    asns = [(number, f'AS Org {number} "quoted", inc') for number in range(1, 80_000)]
+    for database_name, database_file in database_names().items():
+        target = Path(work_dir, database_file)
+        rows = int(database_rows[database_name] * scale)
+        print(f"generating {target} with {rows} rows")
+        with target.with_suffix(".generating").open("w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            for family, family_rows in [(4, int(rows * (1 - ipv6_share))), (6, int(rows * ipv6_share))]:
+                for start, stop in synthetic_ranges(family, family_rows, rng):
+                    ips = [nft_geo_pvc.int_to_ip(family, start), nft_geo_pvc.int_to_ip(family, stop)]
+                    if database_name == "country":
+                        writer.writerow(ips + [rng.choice(countries).upper()])
+                    elif database_name == "city":
+                        writer.writerow(ips + [rng.choice(continents).upper(), rng.choice(countries).upper(),
+                                               rng.choice(regions), "Himeji" if rng.random() < 0.001 else rng.choice(cities),
+                                               "50.85", "4.35"])
+                    elif rng.random() < 0.01:
+                        writer.writerow(ips + [24940, "Hetzner Online GmbH"])
+                    else:
+                        writer.writerow(ips + list(rng.choice(asns)))
+        target.with_suffix(".generating").rename(target)
+
+
+def csv_rows(database_file):
+    with database_file.open("rb") as csv_file:
+        return sum(block.count(b"\n") for block in iter(lambda: csv_file.read(1 << 20), b""))
+
+
+def measure(function, repeat):
+    # best wall and cpu time of repeat runs and the result of the last run
+    best_wall = best_cpu = None
+    for run in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = function()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    return best_wall, best_cpu, result
+
+
+def run_stage(arguments):
+    # runs in a child process, prints one json line with the measurements of the stage
+    work_dir = Path(arguments.work_dir)
+    names = database_names()
+    databases = [names["country"], names["city"], names["asn"]]
+    options = {"engine": arguments.engine, "jobs": arguments.jobs}
+    stage = arguments.run_stage
+    # csv rows parsed by the stage, only the build stage reads the csv databases
+    rows = 0
+    if stage == "build":
+        # the one time csv scan after a download
+        def build():
+            for database_file in names.values():
+                for cache in [nft_geo_pvc.index_path(Path(work_dir, database_file)),
+                              nft_geo_pvc.column_path(Path(work_dir, database_file))]:
+                    if cache.exists():
+                        cache.unlink()
+            nft_geo_pvc.build_indexes(profile(work_dir, **options), *databases)
+        wall, cpu, result = measure(build, arguments.repeat)
+        rows = sum(csv_rows(Path(work_dir, database_file)) for database_file in names.values())
+        items = rows
+    elif stage in stage_filters:
+        bench = profile(work_dir, **options, **stage_filters[stage])
+        wall, cpu, result = measure(lambda: nft_geo_pvc.generate_sets(bench, [bench], *databases), arguments.repeat)
+        # the filters read the prebuilt filter caches, no csv row is parsed: no rows/s
+        ipv4, ipv6 = result[0]
+        items = len(ipv4) + len(ipv6)
+    elif stage in ("write", "parse", "sidecar"):
+        # a large set: every european range of the city database
+        bench = profile(work_dir, **options, continent=["eu"])
+        ipv4, ipv6 = nft_geo_pvc.generate_sets(bench, [bench], *databases)[0]
+        items = len(ipv4) + len(ipv6)
+        if stage == "write":
+            wall, cpu, result = measure(lambda: nft_geo_pvc.write_set(bench, ipv4, ipv6), arguments.repeat)
+        else:
+            # the previous elements for an incremental update, from the set file text or from its sidecar
+            read = nft_geo_pvc.read_set_file if stage == "parse" else nft_geo_pvc.read_set_sidecar
+            nft_geo_pvc.write_set(bench, ipv4, ipv6)
+            wall, cpu, result = measure(lambda: read(bench.target_file, bench.set_name), arguments.repeat)
+    elif stage == "query-host":
+        # the command line lookup, every query opens the indexes again
+        rng = random.Random(arguments.seed)
+        queries = [nft_geo_pvc.int_to_ip(4, rng.randrange(1 << 24, 224 << 24)) for query in range(100)]
+        bench = profile(work_dir, **options)
+
+        def query():
+            with open(os.devnull, "w") as devnull:
+                stdout = sys.stdout
+                sys.stdout = devnull
+                try:
+                    for ip in queries:
+                        bench.query_host = ip
+                        nft_geo_pvc.query_host(bench, *databases)
+                finally:
+                    sys.stdout = stdout
+        wall, cpu, result = measure(query, arguments.repeat)
+        items = len(queries)
+    else:
+        print(f"unknown stage {stage}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps({"stage": stage, "seconds": wall, "cpu_seconds": cpu, "rows": rows, "items": items,
+                      "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark nft_geo_pvc on synthetic db-ip databases")
+    parser.add_argument('--size', choices=sorted(sizes), default="small",
+                        help="database size relative to the real lite databases, default small (1/20)")
+    parser.add_argument('--scale', type=float,
+                        help="custom database size factor, overrides --size")
+    parser.add_argument('--work-dir', default="/tmp/nft_geo_pvc_benchmark",
+                        help="directory for the synthetic databases, reused by later runs of the same size")
+    parser.add_argument('--stages',
+                        default=",".join(["build"] + list(stage_filters) + ["write", "parse", "sidecar", "query-host"]),
+                        help="comma separated stages to run, default all")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per stage, the best time is reported")
+    parser.add_argument('--engine', choices=['auto', 'numpy', 'python'], default='auto')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json',
+                        help="also write the results to this json file")
+    parser.add_argument('--run-stage',
+                        help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    scale = arguments.scale or sizes[arguments.size]
+    work_dir = Path(arguments.work_dir, f"scale-{scale:g}")
+    if arguments.run_stage:
+        arguments.work_dir = str(work_dir)
+        run_stage(arguments)
+        return
+
+    work_dir.mkdir(parents=True, exist_ok=True)
+    if not all(Path(work_dir, database_file).is_file() for database_file in database_names().values()):
+        generate_databases(work_dir, scale, arguments.seed)
+
+    results = []
+    print(f"{'stage':<18} {'seconds':>9} {'cpu':>9} {'rows/s':>12} {'items':>9} {'items/s':>12} {'peak rss':>10}")
+    for stage in arguments.stages.split(","):
+        command = [sys.executable, __file__, '--run-stage', stage, '--work-dir', arguments.work_dir,
+                   '--size', arguments.size, '--repeat', str(arguments.repeat), '--engine', arguments.engine,
+                   '--jobs', str(arguments.jobs), '--seed', str(arguments.seed)]
+        if arguments.scale:
+            command += ['--scale', str(arguments.scale)]
+        r = subprocess.run(command, capture_output=True, text=True)
+        if r.returncode != 0:
+            print(f"{stage:<18} failed:\n{r.stderr}", file=sys.stderr)
+            continue
+        result = json.loads(r.stdout.strip().splitlines()[-1])
+        results.append(result)
+        row_rate = f"{result['rows'] / result['seconds']:,.0f}" if result['rows'] and result['seconds'] else "-"
+        item_rate = f"{result['items'] / result['seconds']:,.0f}" if result['items'] and result['seconds'] else "-"
+        print(f"{stage:<18} {result['seconds']:>9.3f} {result['cpu_seconds']:>9.3f} {row_rate:>12} "
+              f"{result['items']:>9} {item_rate:>12} {result['peak_rss_kb'] / 1024:>8.1f}MB")
+
+    if arguments.json:
+        Path(arguments.json).write_text(json.dumps({"scale": scale, "engine": arguments.engine,
+                                                    "jobs": arguments.jobs, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,25 +26,78 @@ example:
    more examples at https://github.com/pvcbe/nft_geo_pvc/tree/main/example
 """
 import argparse
-import csv
-import ipaddress
 import time
-import gzip
+import threading
 import sys
-import subprocess
 import datetime
+import fnmatch
 import json
 from pathlib import Path
 import socket
-try:
-    import requests
-except ImportError:
-    print("i need the requests library to operate, please install with: pip3 install requests")
-    sys.exit(1)
+import struct
+import mmap
+import bisect
+import re
+import zlib
+import collections
+import contextlib
+import os
+import resource
+import heapq
+import itertools
+from array import array
+# requests, csv, numpy, asyncio, subprocess and hashlib are imported where they are used, so lookups start fast
 
 
 basepath = '/etc/geo_nft'
+# optional numpy module for the vectorized filter engine, False until get_numpy() tried to import it
+np = False
 nft_path = '/usr/sbin/nft'
+# downloaded databases are checked for a newer version at most once per day
+revalidate_interval = 24 * 3600
+
+# csv column of every attribute, per db-ip database
+database_columns = {
+    "country": {"country": 2},
+    "city": {"continent": 2, "country": 3, "region": 4, "city": 5},
+    "asn": {"asn": 2, "as_name": 3},
+}
+
+# binary range index header: magic, byte order, source csv size and mtime, ipv4 rows, ipv6 rows, string table size
+index_magic = b'NFTGEOI1'
+index_header = struct.Struct('<8s8sQqQQQ')
+ipv6_low_mask = (1 << 64) - 1
+
+# attributes kept as dictionary encoded columns in the filter cache, per db-ip database
+filter_columns = {
+    "country": ["country"],
+    "city": ["continent", "region", "city"],
+    "asn": ["asn", "as_name"],
+}
+
+# result cache: magic of the entries, same layout as the filter cache (json header, 8 byte aligned columns)
+result_magic = b'NFTGEOR1'
+result_version = 1
+# set file sidecar (.nft.bin): the element ranges of the written set file in the same layout, for diffing
+set_magic = b'NFTGEOS1'
+# month over month changelog (.delta): the address ranges whose filter attributes changed from the previous
+# version of a database, in the same layout
+delta_magic = b'NFTGEOD1'
+# a previous result is only updated in place while the changed ranges are fewer than this part of its elements,
+# with more changes selecting everything again is faster
+delta_share = 0.05
+
+# elements per add/delete element command when sets are loaded
+element_chunk = 10000
+
+# longest request line of the lookup daemon, about 500000 ip's per batch
+serve_line_limit = 16 << 20
+
+# columnar filter cache: magic and length of the json header describing the columns.
+# the columns are followed by an inverted index per attribute: the row ids ordered by code and per code
+# the offset of its rows
+column_magic = b'NFTGEOC2'
+column_header = struct.Struct('<8sQ')
 
 
 def pprint(text, quiet=False, error=False):
@@ -55,131 +108,1712 @@ def pprint(text, quiet=False, error=False):
             print(text)
 
 
-def find_one(search, search_list):
-    return [s for s in search_list if s == search]
+class RunStats:
+    # wall time, cpu time (including worker processes), row and element counters and peak rss of every stage of a run,
+    # reported with --stats, --stats-json and --stats-prometheus
 
+    counters = ["rows_scanned", "rows_matched", "elements"]
 
-def asnfind(asn, asn_org, asn_filter_list):
-    for asn_search_filter in asn_filter_list:
-        if asn_search_filter == asn or asn_search_filter == asn_org:
-            return True
-    return False
+    def __init__(self):
+        self.stages = {}
+        self.current = None
+        self.databases = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        reset_peak_rss()
+        stage = self.stages.setdefault(name, dict({"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_bytes": 0},
+                                                  **{counter: 0 for counter in self.counters}))
+        self.current = stage
+        wall = time.perf_counter()
+        cpu = sum(os.times()[:4])
+        try:
+            yield stage
+        finally:
+            stage["wall_seconds"] += time.perf_counter() - wall
+            stage["cpu_seconds"] += sum(os.times()[:4]) - cpu
+            stage["peak_rss_bytes"] = max(stage["peak_rss_bytes"], peak_rss())
+            self.current = None
+
+    def count(self, counter, value):
+        if self.current is not None:
+            self.current[counter] += value
+
+    def database(self, database_name, database_file):
+        # size and row count of a database, read from the header of its range index
+        size = database_file.stat().st_size if database_file.is_file() else 0
+        rows = 0
+        try:
+            with index_path(database_file).open('rb') as index_file:
+                header = index_header.unpack(index_file.read(index_header.size))
+            rows = header[4] + header[5]
+        except (OSError, struct.error):
+            pass
+        self.databases[database_name] = {"file": database_file.name, "bytes": size, "rows": rows}
+
+    def report(self):
+        return {"time": time.time(), "stages": self.stages, "databases": self.databases}
+
+    def text(self):
+        lines = [f"{'stage':<10} {'wall s':>9} {'cpu s':>9} {'scanned':>10} {'matched':>10} {'elements':>10} {'peak rss':>10}"]
+        for name, stage in self.stages.items():
+            lines.append(f"{name:<10} {stage['wall_seconds']:>9.3f} {stage['cpu_seconds']:>9.3f} "
+                         f"{stage['rows_scanned']:>10} {stage['rows_matched']:>10} {stage['elements']:>10} "
+                         f"{stage['peak_rss_bytes'] / 1048576:>8.1f}MB")
+        for name, database in self.databases.items():
+            lines.append(f"database {name}: {database['file']}, {database['rows']} rows, {database['bytes']} bytes")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        # textfile collector format
+        lines = []
+        metrics = [("wall_seconds", "wall clock time of the stage"), ("cpu_seconds", "cpu time of the stage"),
+                   ("rows_scanned", "database rows scanned"), ("rows_matched", "database rows matched"),
+                   ("elements", "set elements emitted"), ("peak_rss_bytes", "peak resident memory during the stage")]
+        for metric, description in metrics:
+            lines.append(f"# HELP nft_geo_pvc_stage_{metric} {description}")
+            lines.append(f"# TYPE nft_geo_pvc_stage_{metric} gauge")
+            for name, stage in self.stages.items():
+                lines.append(f'nft_geo_pvc_stage_{metric}{{stage="{name}"}} {stage[metric]}')
+        for metric, description in [("rows", "rows in the database"), ("bytes", "size of the database csv")]:
+            lines.append(f"# HELP nft_geo_pvc_database_{metric} {description}")
+            lines.append(f"# TYPE nft_geo_pvc_database_{metric} gauge")
+            for name, database in self.databases.items():
+                lines.append(f'nft_geo_pvc_database_{metric}{{database="{name}"}} {database[metric]}')
+        lines.append("# HELP nft_geo_pvc_last_run_timestamp_seconds end of the last run")
+        lines.append("# TYPE nft_geo_pvc_last_run_timestamp_seconds gauge")
+        lines.append(f"nft_geo_pvc_last_run_timestamp_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+
+def reset_peak_rss():
+    # linux: restart the peak rss (VmHWM) count so it covers only the next stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
 
 
-def ip_validate_and_add_to_set(start_ip, stop_ip, ipv4, ipv6):
+def peak_rss():
     try:
-        ipaddress.IPv4Address(start_ip)
-        ipaddress.IPv4Address(stop_ip)
-        ipv4.add(start_ip + "-" + stop_ip)
-    except ipaddress.AddressValueError:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+run_stats = RunStats()
+
+
+def write_stats(argument_parser, db_country, db_city, db_asn):
+    if not (argument_parser.stats or argument_parser.stats_json or argument_parser.stats_prometheus):
+        return
+    for database_file_name, database_name in [(db_country, "country"), (db_city, "city"), (db_asn, "asn")]:
+        run_stats.database(database_name, Path(argument_parser.database_path, database_file_name))
+    if argument_parser.stats:
+        pprint(run_stats.text())
+    if argument_parser.stats_json == '-':
+        print(json.dumps(run_stats.report()))
+    elif argument_parser.stats_json:
+        Path(argument_parser.stats_json).write_text(json.dumps(run_stats.report(), indent=2) + "\n")
+    if argument_parser.stats_prometheus:
+        # written next to the target and renamed, the collector never reads a half written file
+        target = Path(argument_parser.stats_prometheus)
+        target.with_suffix(".generating").write_text(run_stats.prometheus())
+        target.with_suffix(".generating").rename(target)
+
+
+def get_numpy():
+    # numpy when it is installed, None otherwise. imported on first use, only filtering and cache building need it
+    global np
+    if np is False:
         try:
-            ipaddress.IPv6Address(start_ip)
-            ipaddress.IPv6Address(stop_ip)
-            ipv6.add(start_ip + "-" + stop_ip)
-        except ipaddress.AddressValueError:
-            pprint(f"WARNING: not an ip: {start_ip}  -  {stop_ip}", error=True)
+            import numpy as np
+        except ImportError:
+            np = None
+    return np
 
 
-def download(argument_parser, db_country, db_city, db_asn):
-    url = 'https://download.db-ip.com/free/'
+class IpRanges:
+    # integer ranges of one address family in compact typed buffers instead of lists of tuples:
+    # ipv4 as 32 bit start and stop columns, ipv6 as the 64 bit high and low halves of start and stop
+
+    def __init__(self, family, columns=None):
+        self.family = family
+        typecode = 'I' if family == 4 else 'Q'
+        self.columns = columns or [array(typecode) for column in range(2 if family == 4 else 4)]
+
+    def append(self, start, stop):
+        if self.family == 4:
+            self.columns[0].append(start)
+            self.columns[1].append(stop)
+        else:
+            self.columns[0].append(start >> 64)
+            self.columns[1].append(start & ipv6_low_mask)
+            self.columns[2].append(stop >> 64)
+            self.columns[3].append(stop & ipv6_low_mask)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        if self.family == 4:
+            return zip(self.columns[0], self.columns[1])
+        return (((start_high << 64) | start_low, (stop_high << 64) | stop_low)
+                for start_high, start_low, stop_high, stop_low in zip(*self.columns))
+
+    def range(self, index):
+        if self.family == 4:
+            return self.columns[0][index], self.columns[1][index]
+        return ((self.columns[0][index] << 64) | self.columns[1][index],
+                (self.columns[2][index] << 64) | self.columns[3][index])
+
+    def find(self, ip, lo=0):
+        # last range starting at or before the ip, searching from range lo on, lo - 1 when there is none
+        if self.family == 4:
+            return bisect.bisect_right(self.columns[0], ip, lo) - 1
+        high, low = ip >> 64, ip & ipv6_low_mask
+        index = bisect.bisect_right(self.columns[0], high, lo)
+        first = bisect.bisect_left(self.columns[0], high, lo, index)
+        if first < index:
+            # ranges sharing the upper 64 bits are ordered by the lower 64 bits
+            index = bisect.bisect_right(self.columns[1], low, first, index)
+        return index - 1
+
+    def extend(self, ranges, start, stop):
+        # copy ranges start to stop of another buffer as blocks
+        for column, source in zip(self.columns, ranges.columns):
+            column.extend(source[start:stop])
+
+
+def parse_range(text):
+    # address family and integer start and stop of an ip, ip-ip range or ip/prefix network,
+    # (None, None, None) if it is none of them
+    text = text.strip()
+    if '-' in text:
+        start_ip, stop_ip = text.split('-', 1)
+        start_family, start = ip_to_int(start_ip.strip())
+        stop_family, stop = ip_to_int(stop_ip.strip())
+        if start_family is None or start_family != stop_family or start > stop:
+            return None, None, None
+        return start_family, start, stop
+    if '/' in text:
+        network_ip, prefix = text.split('/', 1)
+        family, network = ip_to_int(network_ip.strip())
+        bits = 32 if family == 4 else 128
+        if family is None or not prefix.strip().isdigit() or int(prefix) > bits:
+            return None, None, None
+        size = 1 << (bits - int(prefix))
+        network &= ~(size - 1)
+        return family, network, network + size - 1
+    family, ip = ip_to_int(text)
+    return family, ip, ip
+
+
+def merge_ranges(family, sources):
+    # coalesce overlapping and adjacent ranges of start sorted sources in one streaming merge,
+    # the merged ranges are collected in a compact buffer
+    merged = IpRanges(family)
+    last_start = last_stop = None
+    for start, stop in heapq.merge(*sources):
+        if last_start is not None and start < last_start:
+            # a source was not sorted, sort everything instead
+            return merge_ranges(family, [sorted(itertools.chain(*sources))])
+        if last_stop is not None and start <= last_stop + 1:
+            if stop > last_stop:
+                last_stop = stop
+            continue
+        if last_stop is not None:
+            merged.append(last_start, last_stop)
+        last_start, last_stop = start, stop
+    if last_stop is not None:
+        merged.append(last_start, last_stop)
+    return merged
+
+
+def intersect_ranges(family, first, second):
+    # ranges in both sorted, disjoint inputs, one sweep over the two
+    intersection = IpRanges(family)
+    first = iter(first)
+    second = iter(second)
+    first_range = next(first, None)
+    second_range = next(second, None)
+    while first_range is not None and second_range is not None:
+        start = max(first_range[0], second_range[0])
+        stop = min(first_range[1], second_range[1])
+        if start <= stop:
+            intersection.append(start, stop)
+        # the range that ends first can't overlap anything further
+        if first_range[1] < second_range[1]:
+            first_range = next(first, None)
+        else:
+            second_range = next(second, None)
+    return intersection
+
+
+def subtract_ranges(family, first, second):
+    # the parts of the first sorted, disjoint ranges that are not in the second, one sweep over the two
+    difference = IpRanges(family)
+    second = iter(second)
+    second_range = next(second, None)
+    for start, stop in first:
+        while second_range is not None and second_range[1] < start:
+            second_range = next(second, None)
+        while second_range is not None and second_range[0] <= stop:
+            if second_range[0] > start:
+                difference.append(start, second_range[0] - 1)
+            if second_range[1] >= stop:
+                # covers the rest of this range, and maybe the next ranges
+                start = stop + 1
+                break
+            start = second_range[1] + 1
+            second_range = next(second, None)
+        if start <= stop:
+            difference.append(start, stop)
+    return difference
+
+
+def splice_ranges(family, ranges, changed, fresh):
+    # the sorted, disjoint ranges with their parts in the changed ranges replaced by the fresh ranges, which lie
+    # within the changed ranges. the ranges in between are found with bisect and copied as blocks
+    spliced = IpRanges(family)
+
+    def add(start, stop):
+        # coalesced with the last range when they overlap or touch
+        if len(spliced):
+            last_start, last_stop = spliced.range(-1)
+            if start <= last_stop + 1:
+                for column in spliced.columns:
+                    column.pop()
+                start, stop = last_start, max(stop, last_stop)
+        spliced.append(start, stop)
+
+    def copy(start, stop):
+        # the first copied range can touch the last fresh range, the others are disjoint already
+        if start < stop:
+            add(*ranges.range(start))
+            spliced.extend(ranges, start + 1, stop)
+
+    fresh = iter(fresh)
+    fresh_range = next(fresh, None)
+    position = 0
+    # the part of an old range that lies past the last changed range
+    tail = None
+    for change_start, change_stop in changed:
+        if tail is not None:
+            if tail[0] < change_start:
+                add(tail[0], min(tail[1], change_start - 1))
+            tail = (change_stop + 1, tail[1]) if tail[1] > change_stop else None
+        first = ranges.find(change_start, position)
+        if first >= position:
+            copy(position, first)
+            start, stop = ranges.range(first)
+            if start < change_start:
+                add(start, min(stop, change_start - 1))
+            if stop > change_stop:
+                tail = (change_stop + 1, stop)
+            position = first + 1
+        last = ranges.find(change_stop, position)
+        if last >= position:
+            stop = ranges.range(last)[1]
+            if stop > change_stop:
+                tail = (change_stop + 1, stop)
+            position = last + 1
+        while fresh_range is not None and fresh_range[0] <= change_stop:
+            add(*fresh_range)
+            fresh_range = next(fresh, None)
+    if tail is not None:
+        add(*tail)
+    copy(position, len(ranges))
+    return spliced
+
+
+def range_to_cidrs(start, stop, bits):
+    # minimal list of (network, prefix length) covering the range
+    cidrs = []
+    while start <= stop:
+        # largest block aligned on start that does not pass stop
+        size = min((start & -start).bit_length() - 1 if start else bits, (stop - start + 1).bit_length() - 1)
+        cidrs.append((start, bits - size))
+        start += 1 << size
+    return cidrs
+
+
+def element_ranges(family, ranges, cidr=False):
+    # the integer range of every set element as written by format_elements
+    if not cidr:
+        return list(ranges)
+    bits = 32 if family == 4 else 128
+    return [(network, network + (1 << (bits - prefix)) - 1)
+            for start, stop in ranges for network, prefix in range_to_cidrs(start, stop, bits)]
+
+
+def parse_element(family, element):
+    # integer range of a set element written as ip, ip-ip or ip/prefix, None if it can't be parsed
+    element_family, start, stop = parse_range(element)
+    if element_family != family:
+        return None
+    return start, stop
+
+
+def format_elements(family, ranges, cidr=False):
+    # nft set elements for integer ranges, as ranges or as a cidr cover, formatted one at a time
+    bits = 32 if family == 4 else 128
+    for start, stop in ranges:
+        if cidr:
+            for network, prefix in range_to_cidrs(start, stop, bits):
+                if prefix == bits:
+                    yield int_to_ip(family, network)
+                else:
+                    yield f"{int_to_ip(family, network)}/{prefix}"
+        elif start == stop:
+            yield int_to_ip(family, start)
+        else:
+            yield f"{int_to_ip(family, start)}-{int_to_ip(family, stop)}"
+
+
+def element_chunks(elements):
+    # lists of at most element_chunk elements, so large sets are never formatted as a whole
+    elements = iter(elements)
+    while True:
+        chunk = list(itertools.islice(elements, element_chunk))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StreamingDatabase:
+    # decompresses a gzip download chunk by chunk into the csv file and feeds every complete row to the builders,
+    # so the lookup index and filter cache are ready when the download finishes
+    def __init__(self, target, builders):
+        self.target = target
+        self.builders = builders
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.remainder = b''
+
+    def feed(self, compressed):
+        data = self.decompressor.decompress(compressed)
+        while self.decompressor.eof and self.decompressor.unused_data:
+            # next gzip member
+            unused_data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += self.decompressor.decompress(unused_data)
+        self.rows(data)
+
+    def rows(self, data):
+        import csv
+        if not data:
+            return
+        self.target.write(data)
+        lines = (self.remainder + data).split(b'\n')
+        self.remainder = lines.pop()
+        for line in csv.reader([line.decode() for line in lines]):
+            for builder in self.builders:
+                builder.add(line)
+
+    def finish(self):
+        self.rows(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise EOFError("compressed file ended before the end-of-stream marker was reached")
+        if self.remainder:
+            import csv
+            for line in csv.reader([self.remainder.decode()]):
+                for builder in self.builders:
+                    builder.add(line)
+
+
+def download_session(argument_parser):
+    # one pooled session for all downloads, connection errors and server errors are retried with backoff
+    try:
+        import requests
+    except ImportError:
+        print("i need the requests library to download the databases, please install with: pip3 install requests")
+        sys.exit(1)
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=3,
+                          max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
+def download_database(argument_parser, session, database_file_name, database_name, meta):
+    import requests
+    database_file_target = Path(argument_parser.database_path, database_file_name)
+    partial_file = database_file_target.with_suffix(".part")
+    meta_file = database_file_target.with_suffix(".meta")
+
+    # byte ranges only make sense on the compressed file as stored on the server
+    headers = {"Accept-Encoding": "identity"}
+    # the validator of the database on disk is only replaced once a new version is renamed in place, the one of an
+    # unfinished transfer belongs to the .part (older meta files kept it at the top when there was no database yet)
+    partial_meta = meta.get("partial") or ({} if database_file_target.is_file() else meta)
+    if partial_file.is_file() and (partial_meta.get("etag") or partial_meta.get("last_modified")):
+        # resume an interrupted download, If-Range makes the server send the whole file when it changed
+        headers["Range"] = f"bytes={partial_file.stat().st_size}-"
+        headers["If-Range"] = partial_meta.get("etag") or partial_meta.get("last_modified")
+    elif database_file_target.is_file():
+        # revalidation, skipped by the server when the database is unchanged
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    builders = [RangeIndexBuilder(database_name)]
+    if database_name in filter_columns:
+        builders.append(ColumnTableBuilder(database_name))
+    try:
+        r = session.get(argument_parser.download_url + database_file_name + '.gz', headers=headers, stream=True,
+                        timeout=argument_parser.download_timeout)
+        if r.status_code == 304:
+            meta["checked"] = time.time()
+            meta_file.write_text(json.dumps(meta))
+            return
+        if r.status_code not in (200, 206):
+            pprint(f"ERROR: while downloading {database_file_name}", error=True)
+            if r.status_code == 416:
+                partial_file.unlink(missing_ok=True)
+            return
+        validator = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        meta["partial"] = validator
+        meta_file.write_text(json.dumps(meta))
+        pprint(f"{'resuming' if r.status_code == 206 else 'downloading'} {database_file_name}", quiet=argument_parser.quiet)
+        with database_file_target.with_suffix(".downloading").open('wb') as target, \
+                partial_file.open('ab' if r.status_code == 206 else 'wb') as partial:
+            stream = StreamingDatabase(target, builders)
+            if r.status_code == 206:
+                # the csv is rebuilt from the start, decompress the part that is already on disk first
+                with partial_file.open('rb') as downloaded:
+                    for data in iter(lambda: downloaded.read(1 << 16), b''):
+                        stream.feed(data)
+            for data in r.iter_content(chunk_size=1 << 16):
+                partial.write(data)
+                stream.feed(data)
+            stream.finish()
+        database_file_target.with_suffix(".downloading").rename(database_file_target)
+        partial_file.unlink()
+        meta_file.write_text(json.dumps(dict(validator, checked=time.time())))
+        run_stats.count("rows_scanned", len(builders[0].ipv4[0]) + len(builders[0].ipv6[0]))
+        for builder in builders:
+            builder.write(builder.target(database_file_target), database_file_target.stat())
+    except requests.exceptions.RequestException:
+        # keep the partial download, the next run resumes it
+        pprint(f"ERROR: while downloading {database_file_name}", error=True)
+        database_file_target.with_suffix(".downloading").unlink(missing_ok=True)
+    except FileNotFoundError:
+        pprint(f"ERROR: renaming to {database_file_name}, file not found", error=True)
+    except (EOFError, zlib.error):
+        pprint(f"ERROR: while unzipping {database_file_name}", error=True)
+        database_file_target.with_suffix(".downloading").unlink(missing_ok=True)
+        partial_file.unlink(missing_ok=True)
+
+
+def download(argument_parser, db_country, db_city, db_asn):
     download_directory = Path(argument_parser.database_path)
     if not download_directory.is_dir():
         download_directory.mkdir()
 
-    for database_file_name in [db_country, db_city, db_asn]:
+    # a downloaded database is revalidated at most once per interval, most runs don't need a session at all
+    pending = []
+    for database_file_name, database_name in [(db_country, "country"), (db_city, "city"), (db_asn, "asn")]:
         database_file_target = Path(argument_parser.database_path, database_file_name)
-        if not database_file_target.is_file():
-            try:
-                r = requests.get(url + database_file_name + '.gz', stream=True)
-                if r.status_code == 200:
-                    pprint(f"downloading {database_file_name}", quiet=argument_parser.quiet)
-                    with database_file_target.with_suffix(".downloading").open('wb') as target:
-                        with gzip.GzipFile(fileobj=r.raw) as gz:
-                            for data in gz:
-                                target.write(data)
-                    database_file_target.with_suffix(".downloading").rename(database_file_target)
-                else:
-                    pprint(f"ERROR: while downloading {database_file_name}", error=True)
-            except requests.exceptions.ConnectionError as e:
-                pprint(f"ERROR: while downloading {database_file_name}", error=True)
-                try:
-                    database_file_target.with_suffix(".downloading").unlink()
-                except:
-                    pass
-            except FileNotFoundError as e:
-                pprint(f"ERROR: renaming to {database_file_name}, file not found", error=True)
-            except EOFError as e:
-                pprint(f"ERROR: while unzipping {database_file_name}", error=True)
-                try:
-                    database_file_target.unlink()
-                except:
-                    pass
+        try:
+            meta = json.loads(database_file_target.with_suffix(".meta").read_text())
+        except (OSError, ValueError):
+            meta = {}
+        if database_file_target.is_file() and (not (meta.get("etag") or meta.get("last_modified"))
+                                               or time.time() - meta.get("checked", 0) < revalidate_interval):
+            continue
+        pending.append((database_file_name, database_name, meta))
+    if not pending:
+        return
+
+    # the databases are downloaded concurrently over one session
+    from concurrent.futures import ThreadPoolExecutor
+    session = download_session(argument_parser)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        for future in [pool.submit(download_database, argument_parser, session, database_file_name, database_name,
+                                   meta)
+                       for database_file_name, database_name, meta in pending]:
+            future.result()
+    session.close()
+    database_manifest(argument_parser, rescan=True)
+
+
+def directory_mtime(argument_parser):
+    try:
+        return Path(argument_parser.database_path).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def database_manifest(argument_parser, rescan=False):
+    # name -> mtime of the downloaded databases, kept in manifest.json so a run doesn't list the database directory.
+    # rescanned after downloads, when it is missing or out of date, or when files were added to or removed from the
+    # directory since (databases copied in by hand or fetched by another process), which costs one stat
+    manifest_file = Path(argument_parser.database_path, 'manifest.json')
+    scanned = directory_mtime(argument_parser)
+    if not rescan:
+        try:
+            manifest = json.loads(manifest_file.read_text())
+            if manifest["directory_mtime_ns"] == scanned:
+                return manifest["databases"]
+        except (OSError, ValueError, KeyError):
+            pass
+    databases = {database.name: database.stat().st_mtime for database in
+                 Path(argument_parser.database_path).glob('dbip-*.csv')}
+    save_manifest(argument_parser, databases, scanned)
+    return databases
+
+
+def save_manifest(argument_parser, databases, scanned=None):
+    # the manifest is rewritten in place, a rename would change the directory mtime it records. the mtime is taken
+    # before the directory is listed, so a database added in between makes the next run scan again
+    manifest_file = Path(argument_parser.database_path, 'manifest.json')
+    try:
+        manifest_file.touch()
+        if scanned is None:
+            scanned = directory_mtime(argument_parser)
+        manifest_file.write_text(json.dumps({"directory_mtime_ns": scanned, "databases": databases}))
+    except OSError:
+        pass
+
 
 def cleanup_downloads(argument_parser, db_country, db_city, db_asn):
-    glob = Path(argument_parser.database_path).glob('dbip-*.csv')
+    databases = database_manifest(argument_parser)
     # don't delete files if there are only 3 left, this is to ensure there is a working db when downloads fail
-    if len(list(glob)) <= 3:
+    if len(databases) <= 3:
         return
-    for dpip_database in glob:
-        if dpip_database.match(db_country) or dpip_database.match(db_city) or dpip_database.match(db_asn):
+    current = [Path(argument_parser.database_path, db) for db in [db_country, db_city, db_asn]]
+    removed = []
+    delta_bases = []
+    for dpip_database in [Path(argument_parser.database_path, name) for name in databases]:
+        if dpip_database in current:
             continue
-        dpip_database.unlink()
+        # only remove an old database when the current one of the same kind is present
+        database_kind = dpip_database.name.rsplit('-', 2)[0]
+        successors = [db for db in current if db.name.rsplit('-', 2)[0] == database_kind and db.is_file()]
+        if not successors:
+            continue
+        # the changes since this database let the next generation update its results instead of starting over.
+        # they are computed from the filter caches of both versions, so a database with a filter cache is kept
+        # until a run that filters has built the filter cache of its successor
+        if index_is_current(column_path(dpip_database), ColumnTable, dpip_database):
+            if not index_is_current(column_path(successors[0]), ColumnTable, successors[0]):
+                continue
+            write_delta(argument_parser, dpip_database, successors[0])
+            delta_bases.append(dpip_database.name)
+        dpip_database.unlink(missing_ok=True)
+        for derived_file in [index_path(dpip_database), column_path(dpip_database), delta_path(dpip_database),
+                             dpip_database.with_suffix(".meta")]:
+            derived_file.unlink(missing_ok=True)
+        removed.append(dpip_database.name)
+    # cached results of the removed databases can't be hit anymore, but those with a changelog are the base of
+    # the results of the new databases
+    if removed:
+        save_manifest(argument_parser, {name: mtime for name, mtime in databases.items() if name not in removed})
+        evict_results(argument_parser, [name for name in removed if name not in delta_bases])
 
 def get_valid_database_path(argument_parser, db_name):
-    # create glob patern
-    db = db_name.replace(argument_parser.datum, '*')
+    # newest database of the same kind as db_name (any month), from the manifest. raises IndexError when there is none
+    pattern = db_name.replace(argument_parser.datum, '*')
+    databases = database_manifest(argument_parser)
+    for rescan in (False, True):
+        if rescan:
+            databases = database_manifest(argument_parser, rescan=True)
+        found = sorted((mtime, name) for name, mtime in databases.items() if fnmatch.fnmatchcase(name, pattern))
+        if found and Path(argument_parser.database_path, found[-1][1]).is_file():
+            break
+    return Path(argument_parser.database_path, found.pop()[1])
+
+
+def ip_to_int(ip):
+    # returns the address family (4 or 6) and the integer value of an ip, (None, None) if not an ip
+    try:
+        if ':' in ip:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, ValueError):
+        return None, None
+
+
+def int_to_ip(family, ip):
+    if family == 4:
+        return socket.inet_ntop(socket.AF_INET, ip.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, ip.to_bytes(16, 'big'))
+
+
+def index_path(database_file):
+    return Path(database_file).with_suffix('.idx')
+
+
+class RangeIndexBuilder:
+    # collects the rows of one db-ip csv and writes them as a sorted, fixed width range index:
+    # per address family a start, end and string reference column, followed by a string table
+    # holding every distinct attribute tuple once
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self.columns = list(database_columns[database_name].values())
+        self.strings = {}
+        self.string_table = bytearray()
+        self.ipv4 = (array('I'), array('I'), array('I'))
+        self.ipv6 = (array('Q'), array('Q'), array('Q'), array('Q'), array('I'))
+        self.invalid = 0
+
+    def target(self, database_file):
+        return index_path(database_file)
+
+    def reference(self, attributes):
+        offset = self.strings.get(attributes)
+        if offset is None:
+            offset = len(self.string_table)
+            self.strings[attributes] = offset
+            self.string_table += attributes.encode() + b'\x00'
+        return offset
+
+    def add(self, line):
+        if len(line) <= self.columns[-1]:
+            return
+        start_family, start = ip_to_int(line[0])
+        stop_family, stop = ip_to_int(line[1])
+        if start_family is None or start_family != stop_family:
+            self.invalid += 1
+            return
+        offset = self.reference('\x1f'.join([line[c] for c in self.columns]))
+        if start_family == 4:
+            starts, stops, offsets = self.ipv4
+            starts.append(start)
+            stops.append(stop)
+            offsets.append(offset)
+        else:
+            start_high, start_low, stop_high, stop_low, offsets = self.ipv6
+            start_high.append(start >> 64)
+            start_low.append(start & ipv6_low_mask)
+            stop_high.append(stop >> 64)
+            stop_low.append(stop & ipv6_low_mask)
+            offsets.append(offset)
+
+    def merge(self, other):
+        # append the rows of a builder that scanned the next part of the same csv
+        offsets = {offset: self.reference(attributes) for attributes, offset in other.strings.items()}
+        for column, other_column in zip(self.ipv4[:-1] + self.ipv6[:-1], other.ipv4[:-1] + other.ipv6[:-1]):
+            column.extend(other_column)
+        self.ipv4[-1].extend([offsets[offset] for offset in other.ipv4[-1]])
+        self.ipv6[-1].extend([offsets[offset] for offset in other.ipv6[-1]])
+        self.invalid += other.invalid
+
+    def sort(self):
+        # db-ip csv files are sorted, only reorder when a file is not
+        starts = self.ipv4[0]
+        if any(starts[i] > starts[i + 1] for i in range(len(starts) - 1)):
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            self.ipv4 = tuple(array(c.typecode, [c[i] for i in order]) for c in self.ipv4)
+        high, low = self.ipv6[0], self.ipv6[1]
+        keys = list(zip(high, low))
+        if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.ipv6 = tuple(array(c.typecode, [c[i] for i in order]) for c in self.ipv6)
+
+    def write(self, target, source_stat):
+        self.sort()
+        with target.with_suffix(".indexing").open('wb') as index_file:
+            index_file.write(index_header.pack(index_magic, sys.byteorder.encode().ljust(8),
+                                               source_stat.st_size, source_stat.st_mtime_ns,
+                                               len(self.ipv4[0]), len(self.ipv6[0]), len(self.string_table)))
+            for column in self.ipv4 + self.ipv6:
+                index_file.write(column.tobytes())
+                # keep every column 8 byte aligned
+                index_file.write(bytes(-index_file.tell() % 8))
+            index_file.write(self.string_table)
+        target.with_suffix(".indexing").rename(target)
+
+
+class RangeColumns:
+    # searches in the start sorted range columns shared by the range index and the filter cache
+
+    def find_row(self, family, ip, lo=0):
+        # last row starting at or before the ip, searching from row lo on, -1 when there is none
+        if family == 4:
+            return bisect.bisect_right(self.ipv4_start, ip, lo) - 1
+        high, low = ip >> 64, ip & ipv6_low_mask
+        row = bisect.bisect_right(self.ipv6_start_high, high, lo)
+        first = bisect.bisect_left(self.ipv6_start_high, high, lo, row)
+        if first < row:
+            # rows sharing the upper 64 bits are ordered by the lower 64 bits
+            row = bisect.bisect_right(self.ipv6_start_low, low, first, row)
+        return row - 1
+
+    def row_range(self, family, row):
+        if family == 4:
+            return self.ipv4_start[row], self.ipv4_stop[row]
+        return ((self.ipv6_start_high[row] << 64) | self.ipv6_start_low[row],
+                (self.ipv6_stop_high[row] << 64) | self.ipv6_stop_low[row])
+
+    def row_ranges(self, family):
+        # (start, stop, row) of every row in address order
+        if family == 4:
+            return zip(self.ipv4_start, self.ipv4_stop, itertools.count())
+        return (((start_high << 64) | start_low, (stop_high << 64) | stop_low, row)
+                for row, (start_high, start_low, stop_high, stop_low) in
+                enumerate(zip(self.ipv6_start_high, self.ipv6_start_low, self.ipv6_stop_high, self.ipv6_stop_low)))
+
+    def overlapping_rows(self, family, start, stop):
+        # ids of the rows whose range overlaps start-stop
+        first = self.find_row(family, start)
+        if first < 0 or self.row_range(family, first)[1] < start:
+            first += 1
+        return range(first, self.find_row(family, stop) + 1)
+
+
+class RangeIndex(RangeColumns):
+    # read only view on a range index file, the columns are memory mapped and searched with bisect
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self.mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.byteorder, self.source_size, self.source_mtime_ns,
+         ipv4_rows, ipv6_rows, strings_size) = index_header.unpack_from(self.mm)
+        if magic != index_magic:
+            self.mm.close()
+            raise ValueError(f"{path} is not a range index")
+        self.view = memoryview(self.mm)
+        offset = index_header.size
+        columns = []
+        for typecode, rows in [('I', ipv4_rows)] * 3 + [('Q', ipv6_rows)] * 4 + [('I', ipv6_rows)]:
+            size = rows * array(typecode).itemsize
+            columns.append(self.view[offset:offset + size].cast(typecode))
+            offset += size + (-(offset + size) % 8)
+        (self.ipv4_start, self.ipv4_stop, self.ipv4_offset,
+         self.ipv6_start_high, self.ipv6_start_low, self.ipv6_stop_high, self.ipv6_stop_low,
+         self.ipv6_offset) = columns
+        self.strings_offset = offset
+
+    def valid_for(self, database_file):
+        stat = database_file.stat()
+        return (self.byteorder.rstrip() == sys.byteorder.encode()
+                and self.source_size == stat.st_size and self.source_mtime_ns == stat.st_mtime_ns)
+
+    def attributes(self, offset):
+        start = self.strings_offset + offset
+        return self.mm[start:self.mm.find(b'\x00', start)].decode().split('\x1f')
+
+    def row_attributes(self, family, row, ip):
+        # attribute values of the row when its range contains the ip, None otherwise
+        if row < 0:
+            return None
+        if family == 4:
+            if self.ipv4_stop[row] >= ip:
+                return self.attributes(self.ipv4_offset[row])
+            return None
+        if (self.ipv6_stop_high[row], self.ipv6_stop_low[row]) >= (ip >> 64, ip & ipv6_low_mask):
+            return self.attributes(self.ipv6_offset[row])
+        return None
+
+    def lookup(self, family, ip):
+        # returns the attribute values of the range containing the ip, None if there is none
+        return self.row_attributes(family, self.find_row(family, ip), ip)
+
+    def close(self):
+        for column in [self.ipv4_start, self.ipv4_stop, self.ipv4_offset, self.ipv6_start_high,
+                       self.ipv6_start_low, self.ipv6_stop_high, self.ipv6_stop_low, self.ipv6_offset,
+                       self.view]:
+            column.release()
+        self.mm.close()
+
+
+def database_chunks(database_file, jobs):
+    # split a csv in newline aligned byte ranges, one per job
+    size = database_file.stat().st_size
+    boundaries = [0]
+    with database_file.open('rb') as csv_file:
+        for job in range(1, jobs):
+            csv_file.seek(max(size * job // jobs, boundaries[-1]))
+            csv_file.readline()
+            boundaries.append(min(csv_file.tell(), size))
+    boundaries.append(size)
+    return [(start, stop) for start, stop in zip(boundaries, boundaries[1:]) if start < stop]
+
+
+def scan_chunk(database_file, builder_types, start, stop):
+    # worker: feed the rows of one byte range of a csv to new builders and return them
+    import csv
+    import io
+    builders = [builder_type(database_name) for builder_type, database_name in builder_types]
+    with database_file.open('rb') as csv_file:
+        csv_file.seek(start)
+        chunk = csv_file.read(stop - start).decode()
+    # rows end at newlines only, like the single process scan: splitlines() would also split on \x1c-\x1e, \x85,
+    # \u2028 and \u2029 inside the names
+    for line in csv.reader(io.StringIO(chunk, newline='')):
+        for builder in builders:
+            builder.add(line)
+    return builders
+
+
+def scan_database(database_file, builders, jobs=1):
+    # feed every csv row to all builders, one pass over the database.
+    # with more jobs the csv is scanned in byte ranges by a process pool and the partial builders are merged in order
+    chunks = database_chunks(database_file, jobs) if jobs > 1 else []
+    if len(chunks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        builder_types = [(type(builder), builder.database_name) for builder in builders]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for partial_builders in pool.map(scan_chunk, *zip(*[(database_file, builder_types, start, stop)
+                                                                   for start, stop in chunks])):
+                for builder, partial_builder in zip(builders, partial_builders):
+                    builder.merge(partial_builder)
+    else:
+        import csv
+        with database_file.open(newline='') as csv_file:
+            for line in csv.reader(csv_file):
+                for builder in builders:
+                    builder.add(line)
+    run_stats.count("rows_scanned", len(builders[0].ipv4[0]) + len(builders[0].ipv6[0]))
+    for builder in builders:
+        builder.write(builder.target(database_file), database_file.stat())
 
-    glob_dbs = []
-    for db_file in Path(argument_parser.database_path).glob(db):
-      glob_dbs.append(db_file)
 
-    # sort found db's by modify time
-    glob_dbs.sort(key=lambda k:k.stat().st_mtime)
+def build_index(database_file, database_name, quiet=False, jobs=1):
+    pprint(f"building lookup index for {database_file.name}", quiet=quiet)
+    scan_database(database_file, [RangeIndexBuilder(database_name)], jobs)
 
-    # last element is the newest, return it
-    return_db = glob_dbs.pop()
-    #pprint(f"selected db {return_db}")
-    return return_db
 
-def get_family_table(set_name):
-    # detect under which family and table the sets are loaded
-    r = subprocess.run([nft_path, '--json', '--terse', 'list', 'sets'], capture_output=True)
-    if r.returncode == 0:
+def get_index(database_file, database_name, quiet=False, jobs=1):
+    # open the range index of a csv database, (re)build it when missing or outdated
+    target = index_path(database_file)
+    if target.is_file():
         try:
-            j = json.loads(r.stdout.decode())
-            for el in j['nftables']:
-                if 'set' in el:
-                    if set_name == el['set']['name']:
-                        return el['set']['family'], el['set']['table']
-        except json.decoder.JSONDecodeError:
-            pprint("ERROR: can't decode json set information", error=True)
-    return None, None
-
-
-def apply_sets(argument_parser, family, table):
-    # atomic update sets
-    nft_update_file = Path(f"/var/lib/geo_nft_update_{argument_parser.set_name}.nft")
-    # todo: try catch for ro fs
-    with nft_update_file.open('w') as geo_nft:
-        date_string = datetime.datetime.now().isoformat()
-        geo_nft.write(f"""# generated with pvc_geo_nft script on {date_string}
+            index = RangeIndex(target)
+            if index.valid_for(database_file):
+                return index
+            index.close()
+        except (ValueError, struct.error):
+            # empty or truncated index, rebuild
+            pass
+    build_index(database_file, database_name, quiet=quiet, jobs=jobs)
+    return RangeIndex(target)
+
+
+def column_path(database_file):
+    return Path(database_file).with_suffix('.col')
+
+
+def delta_path(database_file):
+    return Path(database_file).with_suffix('.delta')
+
+
+class ColumnTableBuilder:
+    # collects the rows of one db-ip csv as integer range columns plus, for every filter attribute,
+    # a column of small integer codes pointing into a deduplicated dictionary of that attribute
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self.attributes = filter_columns[database_name]
+        self.positions = [database_columns[database_name][a] for a in self.attributes]
+        self.dictionaries = [{} for a in self.attributes]
+        self.ipv4 = (array('I'), array('I'))
+        self.ipv6 = (array('Q'), array('Q'), array('Q'), array('Q'))
+        self.ipv4_codes = [array('I') for a in self.attributes]
+        self.ipv6_codes = [array('I') for a in self.attributes]
+
+    def target(self, database_file):
+        return column_path(database_file)
+
+    def add(self, line):
+        if len(line) <= max(self.positions):
+            return
+        start_family, start = ip_to_int(line[0])
+        stop_family, stop = ip_to_int(line[1])
+        if start_family is None or start_family != stop_family:
+            return
+        if start_family == 4:
+            self.ipv4[0].append(start)
+            self.ipv4[1].append(stop)
+            codes = self.ipv4_codes
+        else:
+            self.ipv6[0].append(start >> 64)
+            self.ipv6[1].append(start & ipv6_low_mask)
+            self.ipv6[2].append(stop >> 64)
+            self.ipv6[3].append(stop & ipv6_low_mask)
+            codes = self.ipv6_codes
+        for position, dictionary, column in zip(self.positions, self.dictionaries, codes):
+            value = line[position]
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(dictionary)
+            column.append(code)
+
+    def merge(self, other):
+        # append the rows of a builder that scanned the next part of the same csv, codes are remapped
+        for column, other_column in zip(self.ipv4 + self.ipv6, other.ipv4 + other.ipv6):
+            column.extend(other_column)
+        for dictionary, other_dictionary, ipv4_codes, ipv6_codes, other_ipv4_codes, other_ipv6_codes in zip(
+                self.dictionaries, other.dictionaries, self.ipv4_codes, self.ipv6_codes,
+                other.ipv4_codes, other.ipv6_codes):
+            codes = [dictionary.setdefault(value, len(dictionary)) for value in other_dictionary]
+            ipv4_codes.extend([codes[code] for code in other_ipv4_codes])
+            ipv6_codes.extend([codes[code] for code in other_ipv6_codes])
+
+    def write(self, target, source_stat):
+        columns = []
+        typecodes = []
+        for dictionary, ipv4_codes, ipv6_codes in zip(self.dictionaries, self.ipv4_codes, self.ipv6_codes):
+            # smallest code width that fits the dictionary
+            typecode = 'B' if len(dictionary) <= 1 << 8 else 'H' if len(dictionary) <= 1 << 16 else 'I'
+            typecodes.append(typecode)
+            columns.append((array(typecode, ipv4_codes), array(typecode, ipv6_codes)))
+        header = json.dumps({
+            "byteorder": sys.byteorder,
+            "source_size": source_stat.st_size,
+            "source_mtime_ns": source_stat.st_mtime_ns,
+            "ipv4_rows": len(self.ipv4[0]),
+            "ipv6_rows": len(self.ipv6[0]),
+            "attributes": self.attributes,
+            "typecodes": typecodes,
+            "dictionaries": [list(dictionary) for dictionary in self.dictionaries],
+        }).encode()
+        with target.with_suffix(".caching").open('wb') as column_file:
+            column_file.write(column_header.pack(column_magic, len(header)))
+            column_file.write(header)
+            column_file.write(bytes(-column_file.tell() % 8))
+            for column in list(self.ipv4) + [c[0] for c in columns] + list(self.ipv6) + [c[1] for c in columns]:
+                column_file.write(column.tobytes())
+                column_file.write(bytes(-column_file.tell() % 8))
+            for family_codes in (self.ipv4_codes, self.ipv6_codes):
+                for dictionary, codes in zip(self.dictionaries, family_codes):
+                    for column in postings(codes, len(dictionary)):
+                        column_file.write(column.tobytes())
+                        column_file.write(bytes(-column_file.tell() % 8))
+        target.with_suffix(".caching").rename(target)
+
+
+def postings(codes, size):
+    # inverted index of a code column: the row ids ordered by code, and the offset of the rows of every code
+    np = get_numpy()
+    if np is not None:
+        code_column = np.frombuffer(codes, dtype=np.uint32)
+        order = array('I', np.argsort(code_column, kind='stable').astype(np.uint32).tobytes())
+        offsets = array('I', np.concatenate(([0], np.cumsum(np.bincount(code_column, minlength=size)))).astype(
+            np.uint32).tobytes())
+        return order, offsets
+    # counting sort
+    offsets = array('I', bytes(4 * (size + 1)))
+    for code in codes:
+        offsets[code + 1] += 1
+    for code in range(size):
+        offsets[code + 1] += offsets[code]
+    positions = array('I', offsets)
+    order = array('I', bytes(4 * len(codes)))
+    for row, code in enumerate(codes):
+        order[positions[code]] = row
+        positions[code] += 1
+    return order, offsets
+
+
+class ColumnTable(RangeColumns):
+    # read only view on a columnar filter cache, columns are memory mapped
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as column_file:
+            self.mm = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = column_header.unpack_from(self.mm)
+        if magic != column_magic:
+            self.mm.close()
+            raise ValueError(f"{path} is not a column cache")
+        self.header = json.loads(self.mm[column_header.size:column_header.size + header_size])
+        self.attributes = self.header["attributes"]
+        self.dictionaries = self.header["dictionaries"]
+        self.view = memoryview(self.mm)
+        offset = column_header.size + header_size
+        offset += -offset % 8
+        self.columns = []
+
+        def column(typecode, rows):
+            nonlocal offset
+            size = rows * array(typecode).itemsize
+            self.columns.append(self.view[offset:offset + size].cast(typecode))
+            offset += size + (-(offset + size) % 8)
+            return self.columns[-1]
+
+        ipv4_rows = self.header["ipv4_rows"]
+        ipv6_rows = self.header["ipv6_rows"]
+        self.ipv4_start = column('I', ipv4_rows)
+        self.ipv4_stop = column('I', ipv4_rows)
+        self.ipv4_codes = {a: column(t, ipv4_rows) for a, t in zip(self.attributes, self.header["typecodes"])}
+        self.ipv6_start_high = column('Q', ipv6_rows)
+        self.ipv6_start_low = column('Q', ipv6_rows)
+        self.ipv6_stop_high = column('Q', ipv6_rows)
+        self.ipv6_stop_low = column('Q', ipv6_rows)
+        self.ipv6_codes = {a: column(t, ipv6_rows) for a, t in zip(self.attributes, self.header["typecodes"])}
+        self.postings = {}
+        for family, rows in [(4, ipv4_rows), (6, ipv6_rows)]:
+            for attribute, dictionary in zip(self.attributes, self.dictionaries):
+                self.postings[family, attribute] = (column('I', rows), column('I', len(dictionary) + 1))
+
+    def valid_for(self, database_file):
+        stat = database_file.stat()
+        return (self.header["byteorder"] == sys.byteorder and self.header["source_size"] == stat.st_size
+                and self.header["source_mtime_ns"] == stat.st_mtime_ns)
+
+    def codes(self, attribute, values):
+        # resolve the requested (lowercase) values to dictionary codes, once per filter run.
+        # values with * ? or [ are shell style patterns matching every value they fit
+        codes = {}
+        patterns = [value for value in values if any(c in value for c in '*?[')]
+        for code, value in enumerate(self.dictionaries[self.attributes.index(attribute)]):
+            value = value.lower()
+            if value in values:
+                codes[code] = value
+            else:
+                for pattern in patterns:
+                    if fnmatch.fnmatchcase(value, pattern):
+                        codes[code] = pattern
+                        break
+        return codes
+
+    def rows(self, family, attribute, code):
+        # row ids with this code, from the inverted index
+        order, offsets = self.postings[family, attribute]
+        return order[offsets[code]:offsets[code + 1]]
+
+    def search(self, attribute, text, mode='substring', limit=None, related=None):
+        # dictionary values that match the search text by prefix, substring or similarity, with their number of
+        # ranges and the values of the related attribute in the same rows.
+        # the closest spelling comes first for fuzzy searches, the most used value for the others
+        values = [value.lower() for value in self.dictionaries[self.attributes.index(attribute)]]
+        if mode == 'fuzzy':
+            import difflib
+            value_codes = {value: code for code, value in reversed(list(enumerate(values)))}
+            codes = [value_codes[value] for value in difflib.get_close_matches(text, values, n=limit or 50, cutoff=0.6)]
+        elif mode == 'prefix':
+            codes = [code for code, value in enumerate(values) if value.startswith(text)]
+        else:
+            codes = [code for code, value in enumerate(values) if text in value]
+        counts = {code: len(self.rows(4, attribute, code)) + len(self.rows(6, attribute, code)) for code in codes}
+        if mode != 'fuzzy':
+            codes.sort(key=lambda code: -counts[code])
+        if limit:
+            codes = codes[:limit]
+        results = []
+        for code in codes:
+            related_values = set()
+            if related:
+                related_dictionary = self.dictionaries[self.attributes.index(related)]
+                for family, code_columns in [(4, self.ipv4_codes), (6, self.ipv6_codes)]:
+                    related_values.update(related_dictionary[related_code] for related_code in
+                                          map(code_columns[related].__getitem__, self.rows(family, attribute, code)))
+            results.append((self.dictionaries[self.attributes.index(attribute)][code], counts[code],
+                            sorted(related_values)))
+        return results
+
+    def dispatch_table(self, profile_filters):
+        # attribute -> code -> [(profile, filter value)], resolved once for all profiles
+        dispatch = {}
+        for profile, attribute_filters in enumerate(profile_filters):
+            for attribute, values in attribute_filters.items():
+                if not values:
+                    continue
+                for code, value in self.codes(attribute, set(values)).items():
+                    dispatch.setdefault(attribute, {}).setdefault(code, []).append((profile, value))
+        return dispatch
+
+    def ranges(self, ipv4_rows, ipv6_rows):
+        # the start and stop columns of the selected rows, gathered straight into range buffers
+        return (self.gather(4, [self.ipv4_start, self.ipv4_stop], ipv4_rows),
+                self.gather(6, [self.ipv6_start_high, self.ipv6_start_low,
+                                self.ipv6_stop_high, self.ipv6_stop_low], ipv6_rows))
+
+    def gather(self, family, columns, rows):
+        typecode = 'I' if family == 4 else 'Q'
+        np = get_numpy()
+        if np is not None and isinstance(rows, np.ndarray):
+            return IpRanges(family, [array(typecode, np.asarray(column)[rows].tobytes()) for column in columns])
+        return IpRanges(family, [array(typecode, map(column.__getitem__, rows)) for column in columns])
+
+    def select(self, profile_filters, profile_hits, numpy_engine=False):
+        # the rows of every requested code are read from the inverted index, each matching row is dispatched to
+        # all profiles that want it. returns the ipv4 and ipv6 ranges per profile and counts the hits per profile
+        # and filter value
+        dispatch = self.dispatch_table(profile_filters)
+        if numpy_engine:
+            return self.select_numpy(dispatch, profile_hits, len(profile_filters))
+        selected = [{4: set(), 6: set()} for profile in profile_filters]
+        for family in (4, 6):
+            for attribute, targets in dispatch.items():
+                for code, matches in targets.items():
+                    rows = self.rows(family, attribute, code)
+                    for profile, value in matches:
+                        profile_hits[profile][attribute][value] += len(rows)
+                        selected[profile][family].update(rows)
+        return [self.ranges(sorted(rows[4]), sorted(rows[6])) for rows in selected]
+
+    def select_within(self, profile_filters, profile_hits, changed):
+        # like select, but only the rows overlapping the changed (ipv4, ipv6) ranges are gathered.
+        # the hits are still those of the whole database, they come from the length of the postings
+        dispatch = self.dispatch_table(profile_filters)
+        for attribute, targets in dispatch.items():
+            for code, matches in targets.items():
+                rows = len(self.rows(4, attribute, code)) + len(self.rows(6, attribute, code))
+                for profile, value in matches:
+                    profile_hits[profile][attribute][value] += rows
+        selected = [{4: set(), 6: set()} for profile in profile_filters]
+        for family, code_columns, family_changed in [(4, self.ipv4_codes, changed[0]),
+                                                     (6, self.ipv6_codes, changed[1])]:
+            for start, stop in family_changed:
+                for row in self.overlapping_rows(family, start, stop):
+                    for attribute, targets in dispatch.items():
+                        for profile, value in targets.get(code_columns[attribute][row], ()):
+                            selected[profile][family].add(row)
+        return [self.ranges(sorted(rows[4]), sorted(rows[6])) for rows in selected]
+
+    def select_numpy(self, dispatch, profile_hits, profiles):
+        # same selection with the posting slices as numpy arrays, rows wanted by several filters are merged once
+        np = get_numpy()
+        selected = [{4: [], 6: []} for profile in range(profiles)]
+        for family in (4, 6):
+            for attribute, targets in dispatch.items():
+                order, offsets = self.postings[family, attribute]
+                order = np.asarray(order)
+                for code, matches in targets.items():
+                    rows = order[offsets[code]:offsets[code + 1]]
+                    for profile, value in matches:
+                        profile_hits[profile][attribute][value] += len(rows)
+                        selected[profile][family].append(rows)
+        results = []
+        for rows in selected:
+            ipv4_rows = np.unique(np.concatenate(rows[4])) if rows[4] else np.zeros(0, dtype=np.intp)
+            ipv6_rows = np.unique(np.concatenate(rows[6])) if rows[6] else np.zeros(0, dtype=np.intp)
+            results.append(self.ranges(ipv4_rows, ipv6_rows))
+        return results
+
+    def close(self):
+        for column in self.columns + [self.view]:
+            column.release()
+        self.mm.close()
+
+
+def changed_ranges(family, old_rows, new_rows, same):
+    # merge sweep over the (start, stop, row) of two versions of a database: the ranges where a row was added or
+    # removed, or where same(old row, new row) says the attributes differ. adjacent changes are coalesced
+    changed = IpRanges(family)
+    last_start = last_stop = None
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    position = 0
+    while True:
+        while old is not None and old[1] < position:
+            old = next(old_rows, None)
+        while new is not None and new[1] < position:
+            new = next(new_rows, None)
+        if old is None and new is None:
+            break
+        old_here = old if old is not None and old[0] <= position else None
+        new_here = new if new is not None and new[0] <= position else None
+        if old_here is None and new_here is None:
+            position = min(row[0] for row in (old, new) if row is not None)
+            continue
+        # the piece up to the next boundary of either version
+        stop = min([row[1] for row in (old_here, new_here) if row is not None]
+                   + [row[0] - 1 for row in (old, new) if row is not None and row[0] > position])
+        if old_here is None or new_here is None or not same(old_here[2], new_here[2]):
+            if last_stop is not None and last_stop == position - 1:
+                last_stop = stop
+            else:
+                if last_stop is not None:
+                    changed.append(last_start, last_stop)
+                last_start, last_stop = position, stop
+        position = stop + 1
+    if last_stop is not None:
+        changed.append(last_start, last_stop)
+    return changed
+
+
+def database_delta(old_table, new_table):
+    # changed ipv4 and ipv6 ranges between two versions of a filter cache, codes are compared through a mapping of
+    # the old dictionaries onto the new ones, so every row pair costs a few integer compares
+    mappings = []
+    for attribute in new_table.attributes:
+        new_codes = {value: code for code, value in
+                     enumerate(new_table.dictionaries[new_table.attributes.index(attribute)])}
+        mappings.append((attribute, [new_codes.get(value, -1) for value in
+                                     old_table.dictionaries[old_table.attributes.index(attribute)]]))
+    changed = []
+    for family, old_codes, new_codes in [(4, old_table.ipv4_codes, new_table.ipv4_codes),
+                                         (6, old_table.ipv6_codes, new_table.ipv6_codes)]:
+        columns = [(mapping, old_codes[attribute], new_codes[attribute]) for attribute, mapping in mappings]
+
+        def same(old_row, new_row):
+            return all(mapping[old_column[old_row]] == new_column[new_row]
+                       for mapping, old_column, new_column in columns)
+        changed.append(changed_ranges(family, iter(old_table.row_ranges(family)), iter(new_table.row_ranges(family)),
+                                      same))
+    return changed
+
+
+def write_delta(argument_parser, old_database, new_database):
+    # changelog of a database against the version of the previous month from their current filter caches
+    pprint(f"computing changes from {old_database.name} to {new_database.name}", quiet=argument_parser.quiet)
+    old_table = ColumnTable(column_path(old_database))
+    new_table = ColumnTable(column_path(new_database))
+    ipv4, ipv6 = database_delta(old_table, new_table)
+    rows = len(new_table.ipv4_start) + len(new_table.ipv6_start_high)
+    old_table.close()
+    new_table.close()
+    stat = new_database.stat()
+    write_ranges_file(delta_path(new_database), delta_magic, {
+        "old": old_database.name,
+        "new": new_database.name,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+    }, ipv4, ipv6)
+    pprint(f"{new_database.name}: {len(ipv4)} ipv4 and {len(ipv6)} ipv6 ranges changed in {rows} rows",
+           quiet=argument_parser.quiet)
+
+
+def read_delta(old_name, new_database):
+    # changed (ipv4, ipv6) ranges from the database named old_name to new_database, None without a changelog
+    stored = read_ranges_file(delta_path(new_database), delta_magic)
+    if stored is None:
+        return None
+    header, ipv4, ipv6 = stored
+    stat = new_database.stat()
+    if (header["old"] != old_name or header["source_size"] != stat.st_size
+            or header["source_mtime_ns"] != stat.st_mtime_ns):
+        return None
+    return ipv4, ipv6
+
+
+def build_columns(database_file, database_name, quiet=False, jobs=1):
+    pprint(f"building filter cache for {database_file.name}", quiet=quiet)
+    scan_database(database_file, [ColumnTableBuilder(database_name)], jobs)
+
+
+def get_columns(database_file, database_name, quiet=False, jobs=1):
+    # open the columnar filter cache of a csv database, (re)build it when missing or outdated
+    target = column_path(database_file)
+    if target.is_file():
+        try:
+            table = ColumnTable(target)
+            if table.valid_for(database_file):
+                return table
+            table.close()
+        except (ValueError, struct.error):
+            # empty or truncated cache, rebuild
+            pass
+    build_columns(database_file, database_name, quiet=quiet, jobs=jobs)
+    return ColumnTable(target)
+
+
+def index_is_current(target, reader, database_file):
+    if not target.is_file():
+        return False
+    try:
+        opened = reader(target)
+    except (ValueError, struct.error):
+        return False
+    current = opened.valid_for(database_file)
+    opened.close()
+    return current
+
+
+def build_indexes(argument_parser, db_country, db_city, db_asn, filter_caches=True):
+    # one time step after downloading, later runs only compare the csv size and mtime.
+    # lookups only need the range index, the filter caches are checked and built when filtering
+    for database_file_name, database_name in [(db_country, "country"), (db_city, "city"), (db_asn, "asn")]:
+        database_file = Path(argument_parser.database_path, database_file_name)
+        if not database_file.is_file():
+            continue
+        builders = []
+        if not index_is_current(index_path(database_file), RangeIndex, database_file):
+            pprint(f"building lookup index for {database_file.name}", quiet=argument_parser.quiet)
+            builders.append(RangeIndexBuilder(database_name))
+        if (filter_caches and database_name in filter_columns
+                and not index_is_current(column_path(database_file), ColumnTable, database_file)):
+            pprint(f"building filter cache for {database_file.name}", quiet=argument_parser.quiet)
+            builders.append(ColumnTableBuilder(database_name))
+        if builders:
+            scan_database(database_file, builders, argument_parser.jobs)
+
+
+class NftCommand:
+    # default backend: the nft binary, set updates are written to a text file and loaded with nft -f
+    name = 'nft'
+
+    def available(self):
+        import subprocess
+        try:
+            r = subprocess.run([nft_path, '--version'], capture_output=True)
+            if r.returncode == 0:
+                return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def list_json(self, command, terse=False):
+        # output of an nft list command in json, None when the command fails
+        import subprocess
+        r = subprocess.run([nft_path, '--json'] + (['--terse'] if terse else []) + command, capture_output=True)
+        if r.returncode != 0:
+            return None
+        return decode_nft_json(r.stdout.decode())
+
+    def apply(self, operations, update_name):
+        # returns None on success, the error of nft otherwise
+        nft_update_file = Path(f"/var/lib/geo_nft_update_{update_name}.nft")
+        # todo: try catch for ro fs
+        with nft_update_file.open('w') as geo_nft:
+            date_string = datetime.datetime.now().isoformat()
+            geo_nft.write(f"""# generated with pvc_geo_nft script on {date_string}
+
+""")
+            for operation in operations:
+                if operation[0] == 'flush':
+                    action, family, table, set_name = operation
+                    geo_nft.write(f"flush set {family} {table} {set_name};\n")
+                elif operation[0] == 'load':
+                    action, family, table, profile, ipv4, ipv6 = operation
+                    self.elements(geo_nft, 'add', family, table, f"{profile.set_name}_ipv4", 4, ipv4, profile.cidr)
+                    self.elements(geo_nft, 'add', family, table, f"{profile.set_name}_ipv6", 6, ipv6, profile.cidr)
+                else:
+                    self.elements(geo_nft, *operation)
+        import subprocess
+        r = subprocess.run([nft_path, '-f', nft_update_file], capture_output=True)
+        nft_update_file.unlink()
+        if r.returncode == 0:
+            return None
+        return r.stderr.decode()
+
+    def elements(self, geo_nft, action, family, table, set_name, ip_family, ranges, cidr):
+        # one add or delete element statement per element_chunk elements, nft parses them one by one
+        for chunk in element_chunks(format_elements(ip_family, ranges, cidr)):
+            geo_nft.write(f"{action} element {family} {table} {set_name} {{ " + ", ".join(chunk) + " };\n")
+
+
+class LibNftables:
+    # the libnftables python bindings: the update is sent as one json batch, no nft text is generated or parsed
+    name = 'libnftables'
+
+    def __init__(self):
+        try:
+            import nftables
+            self.nft = nftables.Nftables()
+        except (ImportError, OSError):
+            self.nft = None
+
+    def available(self):
+        return self.nft is not None
+
+    def list_json(self, command, terse=False):
+        self.nft.set_json_output(True)
+        if hasattr(self.nft, 'set_terse_output'):
+            self.nft.set_terse_output(terse)
+        rc, output, error = self.nft.cmd(" ".join(command))
+        if rc != 0:
+            return None
+        return decode_nft_json(output)
+
+    def apply(self, operations, update_name):
+        rc, output, error = self.nft.json_cmd(json_batch(operations))
+        if rc == 0:
+            return None
+        return error
+
+
+class MockNftables:
+    # stand in for nftables that keeps the sets in a json file, the json batch of the libnftables backend is
+    # validated and applied as one transaction. for testing without root, the sets must be present in the file:
+    #   {"sets": [{"family": "inet", "table": "filter", "name": "geo_set_ipv4", "type": "ipv4_addr", "elem": []}]}
+    name = 'mock'
+
+    def __init__(self, state_file):
+        self.state_file = Path(state_file)
+
+    def available(self):
+        return True
+
+    def state(self):
+        try:
+            return json.loads(self.state_file.read_text())
+        except (OSError, ValueError):
+            return {"sets": []}
+
+    def list_json(self, command, terse=False):
+        sets = self.state()["sets"]
+        if command[:2] == ['list', 'sets']:
+            return {"nftables": [{"set": {key: value for key, value in nft_set.items() if key != 'elem' or not terse}}
+                                 for nft_set in sets]}
+        if command[:2] == ['list', 'set'] and len(command) == 5:
+            for nft_set in sets:
+                if [nft_set['family'], nft_set['table'], nft_set['name']] == command[2:]:
+                    return {"nftables": [{"set": nft_set}]}
+        return None
+
+    def apply(self, operations, update_name):
+        state = self.state()
+        sets = {(nft_set['family'], nft_set['table'], nft_set['name']): nft_set for nft_set in state["sets"]}
+        # elements by their json text, per set
+        elements = {}
+        for command in json_batch(operations)["nftables"]:
+            (action, target), = command.items()
+            target = target.get('set') or target.get('element')
+            name = (target['family'], target['table'], target['name'])
+            if name not in sets:
+                return f"Error: No such file or directory; set {target['name']} in table {target['table']} does not exist"
+            if name not in elements:
+                elements[name] = {json.dumps(element, sort_keys=True): element for element in sets[name].get('elem', [])}
+            if action == 'flush':
+                elements[name].clear()
+            elif action == 'add':
+                for element in target['elem']:
+                    elements[name].setdefault(json.dumps(element, sort_keys=True), element)
+            else:
+                for element in target['elem']:
+                    if elements[name].pop(json.dumps(element, sort_keys=True), None) is None:
+                        return f"Error: Could not process rule: No such file or directory, element {element}"
+        for name, set_elements in elements.items():
+            sets[name]['elem'] = list(set_elements.values())
+        # nothing is written unless the whole batch applied
+        self.state_file.write_text(json.dumps(state, indent=1) + "\n")
+        return None
+
+
+def get_backend(argument_parser):
+    if argument_parser.backend == 'libnftables':
+        return LibNftables()
+    if argument_parser.backend == 'mock':
+        return MockNftables(argument_parser.mock_state or Path(basepath, 'mock_nftables.json'))
+    return NftCommand()
+
 
-flush set {family} {table} {argument_parser.set_name}_ipv4;
-flush set {family} {table} {argument_parser.set_name}_ipv6;
-table {family} {table} """)
-        geo_nft.write("{\n")
-        geo_nft.write(f"""    include "{argument_parser.target_file}";\n""")
-        geo_nft.write("}\n")
-    r = subprocess.run([nft_path, '-f', nft_update_file], capture_output=True)
-    nft_update_file.unlink()
-    if r.returncode == 0:
+def decode_nft_json(output):
+    try:
+        return json.loads(output)
+    except json.decoder.JSONDecodeError:
+        pprint("ERROR: can't decode json set information", error=True)
+        return None
+
+
+def json_elements(family, ranges, cidr=False):
+    # set elements in the json format of libnftables
+    bits = 32 if family == 4 else 128
+    for start, stop in ranges:
+        if cidr:
+            for network, prefix in range_to_cidrs(start, stop, bits):
+                if prefix == bits:
+                    yield int_to_ip(family, network)
+                else:
+                    yield {"prefix": {"addr": int_to_ip(family, network), "len": prefix}}
+        elif start == stop:
+            yield int_to_ip(family, start)
+        else:
+            yield {"range": [int_to_ip(family, start), int_to_ip(family, stop)]}
+
+
+def json_batch(operations):
+    # one json batch for all operations, elements are added in chunks of element_chunk per command
+    commands = []
+
+    def elements(action, family, table, set_name, ip_family, ranges, cidr):
+        for chunk in element_chunks(json_elements(ip_family, ranges, cidr)):
+            commands.append({action: {"element": {"family": family, "table": table, "name": set_name,
+                                                  "elem": chunk}}})
+
+    for operation in operations:
+        if operation[0] == 'flush':
+            action, family, table, set_name = operation
+            commands.append({"flush": {"set": {"family": family, "table": table, "name": set_name}}})
+        elif operation[0] == 'load':
+            action, family, table, profile, ipv4, ipv6 = operation
+            elements('add', family, table, f"{profile.set_name}_ipv4", 4, ipv4, profile.cidr)
+            elements('add', family, table, f"{profile.set_name}_ipv6", 6, ipv6, profile.cidr)
+        else:
+            elements(*operation)
+    return {"nftables": commands}
+
+
+def get_family_tables(argument_parser):
+    # detect under which family and table the sets are loaded, one list call for all sets
+    family_tables = {}
+    j = argument_parser.nft.list_json(['list', 'sets'], terse=True)
+    if j is not None:
+        for el in j['nftables']:
+            if 'set' in el:
+                family_tables.setdefault(el['set']['name'], (el['set']['family'], el['set']['table']))
+    return family_tables
+
+
+def read_set_file(target_file, set_name):
+    # element ranges of a previously generated set file, None when there is no usable file
+    try:
+        text = Path(target_file).read_text()
+    except OSError:
+        return None
+    elements = {}
+    for family in (4, 6):
+        block = re.search(r'set %s_ipv%d \{[^}]*?(?:elements = \{([^}]*)\}|\})' % (re.escape(set_name), family), text)
+        if not block:
+            return None
+        ranges = []
+        for element in (block.group(1) or '').split(','):
+            if element.strip():
+                parsed = parse_element(family, element)
+                if parsed is None:
+                    return None
+                ranges.append(parsed)
+        elements[family] = ranges
+    return elements[4], elements[6]
+
+
+def sidecar_path(target_file):
+    return Path(target_file).with_name(Path(target_file).name + '.bin')
+
+
+def read_set_sidecar(target_file, set_name):
+    # element ranges of a previously generated set file from its binary sidecar, None when the sidecar is missing
+    # or doesn't belong to the set file as it is now
+    try:
+        stat = Path(target_file).stat()
+    except OSError:
+        return None
+    stored = read_ranges_file(sidecar_path(target_file), set_magic)
+    if stored is None:
+        return None
+    header, ipv4, ipv6 = stored
+    if (header.get("set_name") != set_name or header.get("nft_size") != stat.st_size
+            or header.get("nft_mtime_ns") != stat.st_mtime_ns):
+        return None
+    return ipv4, ipv6
+
+
+def read_previous_set(target_file, set_name):
+    # the sidecar is read when it matches the set file, the text is only parsed as a fallback
+    previous = read_set_sidecar(target_file, set_name)
+    if previous is None:
+        previous = read_set_file(target_file, set_name)
+    return previous
+
+
+def json_element_range(family, element):
+    # integer range of an element from nft --json output
+    if isinstance(element, dict) and 'elem' in element:
+        element = element['elem']['val']
+    if isinstance(element, dict) and 'range' in element:
+        return parse_element(family, f"{element['range'][0]}-{element['range'][1]}")
+    if isinstance(element, dict) and 'prefix' in element:
+        return parse_element(family, f"{element['prefix']['addr']}/{element['prefix']['len']}")
+    if isinstance(element, str):
+        return parse_element(family, element)
+    return None
+
+
+def read_live_set(argument_parser, family, table, set_name, ip_family):
+    # element ranges of a set loaded in the kernel, None when the set can't be listed
+    j = argument_parser.nft.list_json(['list', 'set', family, table, set_name])
+    if j is None:
+        return None
+    for el in j['nftables']:
+        if 'set' in el:
+            ranges = [json_element_range(ip_family, element) for element in el['set'].get('elem', [])]
+            if None in ranges:
+                return None
+            return ranges
+    return None
+
+
+def diff_elements(old, new):
+    # elements to delete and to add to go from the old to the new element list
+    old_set = set(old)
+    new_set = set(new)
+    return sorted(old_set - new_set), sorted(new_set - old_set)
+
+
+def ranges_near(ranges, changed):
+    # the ranges of a start sorted, disjoint list that overlap or touch the sorted changed ranges, found with bisect
+    near = []
+    position = 0
+    for start, stop in changed:
+        first = bisect.bisect_left(ranges, (start,), position)
+        if first > position and ranges[first - 1][1] + 1 >= start:
+            first -= 1
+        last = bisect.bisect_left(ranges, (stop + 2,), first)
+        near.extend(ranges[first:last])
+        position = last
+    return near
+
+
+def incremental_operations(argument_parser, profile, family, table, ipv4, ipv6, previous):
+    # add/delete element operations for one profile, None when a full reload is needed
+    if argument_parser.incremental == 'live':
+        previous = (read_live_set(argument_parser, family, table, f"{profile.set_name}_ipv4", 4),
+                    read_live_set(argument_parser, family, table, f"{profile.set_name}_ipv6", 6))
+        if None in previous:
+            previous = None
+    if previous is None:
+        pprint(f"no previous elements found for {profile.set_name}, full reload", quiet=argument_parser.quiet)
+        return None
+    operations = []
+    changes = 0
+    new_elements = 0
+    for ip_family, old, new in [(4, previous[0], ipv4), (6, previous[1], ipv6)]:
+        new = element_ranges(ip_family, new, profile.cidr)
+        new_elements += len(new)
+        if profile.delta_ranges and argument_parser.incremental != 'live' and not profile.cidr:
+            # outside the changed ranges of the databases the elements are those of the previous result
+            changed = profile.delta_ranges[0 if ip_family == 4 else 1]
+            old = ranges_near(list(old), changed)
+            new = ranges_near(new, changed)
+        delete, add = diff_elements(old, new)
+        changes += len(delete) + len(add)
+        set_name = f"{profile.set_name}_ipv{ip_family}"
+        # deletes go first, the new elements never overlap the elements that are kept
+        if delete:
+            operations.append(('delete', family, table, set_name, ip_family, delete, profile.cidr))
+        if add:
+            operations.append(('add', family, table, set_name, ip_family, add, profile.cidr))
+    if changes > argument_parser.max_diff * max(new_elements, 1):
+        pprint(f"{profile.set_name}: {changes} changed elements, diff too large, full reload", quiet=argument_parser.quiet)
+        return None
+    pprint(f"{profile.set_name}: incremental update with {changes} changed elements", quiet=argument_parser.quiet)
+    return operations
+
+
+def apply_sets(argument_parser, targets, previous=None, incremental=True):
+    # atomic update of the sets of all (profile, family, table) targets in one nft transaction
+    update_name = Path(argument_parser.config).stem if argument_parser.config else argument_parser.set_name
+    previous = previous or {}
+    operations = []
+    for profile, family, table, ipv4, ipv6 in targets:
+        profile_operations = None
+        if incremental and (argument_parser.incremental or profile.delta_ranges):
+            profile_operations = incremental_operations(argument_parser, profile, family, table, ipv4, ipv6,
+                                                        previous.get(profile.set_name))
+        if profile_operations is None:
+            profile_operations = [('flush', family, table, f"{profile.set_name}_ipv4"),
+                                  ('flush', family, table, f"{profile.set_name}_ipv6"),
+                                  ('load', family, table, profile, ipv4, ipv6)]
+        operations.extend(profile_operations)
+    error = argument_parser.nft.apply(operations, update_name)
+    if error is None:
         pprint("sets applied", quiet=argument_parser.quiet)
-    else:
-        pprint(
-            f"error while activating set: \nvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv\n",
-            error=True)
-        pprint(r.stderr.decode(), error=True)
+        return True
+    if incremental and (argument_parser.incremental or any(target[0].delta_ranges for target in targets)):
+        # the previous elements did not match the live sets, the transaction is aborted as a whole
+        pprint("incremental update failed, falling back to a full reload", error=True)
+        return apply_sets(argument_parser, targets, incremental=False)
+    pprint(
+        f"error while activating set: \nvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv\n",
+        error=True)
+    pprint(error, error=True)
+    return False
 
 def split_arg_list(source_list):
     final_list = []
@@ -189,223 +1823,943 @@ def split_arg_list(source_list):
          final_list.append(element.strip())
     return final_list
 
-def generate_sets(argument_parser, db_country, db_city, db_asn):
-    ipv4_set = set()
-    ipv6_set = set()
 
-    # custom ip's
-    custom_ips_list = split_arg_list(argument_parser.custom_ips)
-    if custom_ips_list:
-        for custom_ip in custom_ips_list:
-            if '-' in custom_ip:
-                try:
-                    splited_custom_ip_start, splited_custom_ip_stop = custom_ip.split('-')
-                    ip_validate_and_add_to_set(splited_custom_ip_start, splited_custom_ip_stop, ipv4_set, ipv6_set)
-                except ValueError:
-                    pprint(f"ERROR: invalid ip or range {custom_ip}")
-            else:
-                # values added to set needs to be a string
-                try:
-                    ipv4_set.add(str(ipaddress.IPv4Network(custom_ip, strict=False)))
-                except:
-                    try:
-                        ipv6_set.add(str(ipaddress.IPv6Network(custom_ip, strict=False)))
-                    except:
-                        try:
-                            for ip in socket.getaddrinfo(custom_ip, 0):
-                                if ip[1] is socket.SocketKind.SOCK_RAW and ip[0] is socket.AddressFamily.AF_INET:
-                                    ipv4_set.add(str(ipaddress.IPv4Address(ip[4][0])))
-                                if ip[1] is socket.SocketKind.SOCK_RAW and ip[0] is socket.AddressFamily.AF_INET6:
-                                    ipv6_set.add(str(ipaddress.IPv6Address(ip[4][0])))
-                        except socket.gaierror:
-                            pprint(f"WARNING: host {custom_ip} not an ip address and not resolvable via dns",
-                               error=True)
-
-    # asn
-    asn_filter_list = split_arg_list(argument_parser.asn)
-    if asn_filter_list:
-        db = get_valid_database_path(argument_parser, db_asn)
-        if db.is_file():
-            hit_asn = {}
-            for asn in asn_filter_list:
-                hit_asn[asn] = 0
-            asn_csv = db.open()
-            csv_reader = csv.reader(asn_csv)
-            for line in csv_reader:
-                if len(line) >= 4:
-                    start = line[0]
-                    stop = line[1]
-                    asn = line[2].lower()
-                    as_org = line[3].lower()
-                    af = asnfind(asn, as_org, asn_filter_list)
-                    if af:
-                        if asn in hit_asn:
-                          hit_asn[asn] += 1
-                        elif as_org in hit_asn:
-                          hit_asn[as_org] += 1
-                        ip_validate_and_add_to_set(start, stop, ipv4_set, ipv6_set)
-            for a, hit in hit_asn.items():
-                if hit == 0:
-                    pprint(f"WARNING: no hit found for AS: {a}", error=True)
-            asn_csv.close()
+def load_profiles(argument_parser):
+    # read the named set profiles from a json or toml config file:
+    #   {"profiles": {"<set-name>": {"country": ["be"], "asn": ["..."], "apply": true}, ...}}
+    config_file = Path(argument_parser.config)
+    try:
+        if config_file.suffix == '.toml':
+            import tomllib
+            config = tomllib.loads(config_file.read_text())
         else:
-            pprint(f"ERROR: asn database {db} missing", error=True)
-
-
-    # country
-    country_filter_list = split_arg_list(argument_parser.country)
-    if country_filter_list:
-        db = get_valid_database_path(argument_parser, db_country)
-        if db.is_file():
-            hit_country = {}
-            for c in country_filter_list:
-                hit_country[c] = 0
-            csv_reader = csv.reader(db.open())
-            for line in csv_reader:
-                if len(line) >= 3:
-                    start = line[0]
-                    stop = line[1]
-                    line_country = line[2].lower()
-                    if find_one(line_country, country_filter_list):
-                        hit_country[line_country] += 1
-                        ip_validate_and_add_to_set(start, stop, ipv4_set, ipv6_set)
-            for c, hit in hit_country.items():
-                if hit == 0:
-                    pprint(f"WARNING: no hit found for country: {c}", error=True)
+            config = json.loads(config_file.read_text())
+    except ImportError:
+        pprint("ERROR: toml config files need python 3.11 or newer, use a json config file", error=True)
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        pprint(f"ERROR: can't read config file {config_file}: {e}", error=True)
+        sys.exit(1)
+
+    profiles = []
+    for set_name, options in config.get("profiles", {}).items():
+        unknown = set(options) - set(filter_names) - {'custom_ips', 'custom_ips_file', 'custom_hosts_file', 'filter',
+                                                      'cidr', 'apply'}
+        if unknown:
+            pprint(f"ERROR: unknown option(s) {', '.join(sorted(unknown))} in profile {set_name}", error=True)
+            sys.exit(1)
+        profile = argparse.Namespace(set_name=set_name,
+                                     quiet=argument_parser.quiet,
+                                     cidr=options.get('cidr', argument_parser.cidr),
+                                     apply=options.get('apply', argument_parser.apply),
+                                     custom_ips_file=options.get('custom_ips_file'),
+                                     custom_hosts_file=options.get('custom_hosts_file'),
+                                     filter=options.get('filter'))
+        if profile.filter:
+            try:
+                parse_filter(profile.filter)
+            except ValueError as e:
+                pprint(f"ERROR: invalid filter in profile {set_name}: {e}", error=True)
+                sys.exit(1)
+        for option in list(filter_names) + ['custom_ips']:
+            values = options.get(option, [])
+            if not isinstance(values, list):
+                values = [values]
+            setattr(profile, option, [str(value).lower() for value in values])
+        profiles.append(profile)
+    if not profiles:
+        pprint(f"ERROR: no profiles found in config file {config_file}", error=True)
+        sys.exit(1)
+    return profiles
+
+def resolve_hosts(hostnames, workers, timeout):
+    # getaddrinfo for every hostname, at most workers lookups at the same time. a lookup that takes longer than
+    # timeout is given up, the daemon threads of hanging lookups don't block the run or the exit.
+    # returns the sorted ip's per resolved hostname, failed and timed out hostnames are left out
+    answers = {}
+    finished = threading.Condition()
+
+    def resolve(hostname):
+        try:
+            ips = sorted({info[4][0] for info in socket.getaddrinfo(hostname, 0, proto=socket.IPPROTO_TCP)})
+        except (socket.gaierror, UnicodeError):
+            ips = None
+        with finished:
+            answers[hostname] = ips
+            finished.notify_all()
+
+    pending = list(hostnames)
+    active = {}
+    with finished:
+        while pending or active:
+            now = time.monotonic()
+            for hostname, started in list(active.items()):
+                if hostname in answers or now - started >= timeout:
+                    del active[hostname]
+            while pending and len(active) < workers:
+                hostname = pending.pop()
+                active[hostname] = now
+                threading.Thread(target=resolve, args=(hostname,), daemon=True).start()
+            if active:
+                finished.wait(max(0.01, min(active.values()) + timeout - now))
+        return {hostname: ips for hostname, ips in answers.items() if ips}
+
+
+def resolve_hostnames(argument_parser, hostnames):
+    # resolve hostnames with an on disk cache of the last good answers: answers younger than --dns-ttl are used
+    # without a lookup, older answers are served when the lookup fails or times out
+    cache_file = Path(argument_parser.database_path, 'dns_cache.json')
+    try:
+        cache = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    now = time.time()
+    lookups = [hostname for hostname in set(hostnames)
+               if hostname not in cache or now - cache[hostname]["time"] > argument_parser.dns_ttl]
+    answers = resolve_hosts(lookups, argument_parser.dns_workers, argument_parser.dns_timeout) if lookups else {}
+    for hostname in lookups:
+        if hostname in answers:
+            cache[hostname] = {"ips": answers[hostname], "time": now}
+        elif hostname in cache:
+            pprint(f"WARNING: host {hostname} not resolvable via dns, using the last known ip's "
+                   f"from {datetime.datetime.fromtimestamp(cache[hostname]['time']).isoformat(timespec='seconds')}",
+                   error=True)
+        else:
+            pprint(f"WARNING: host {hostname} not an ip address and not resolvable via dns", error=True)
+    if answers:
+        try:
+            cache_file.with_suffix(".saving").write_text(json.dumps(cache, indent=1) + "\n")
+            cache_file.with_suffix(".saving").rename(cache_file)
+        except OSError:
+            pprint(f"ERROR: can't write dns cache {cache_file}", error=True)
+    return {hostname: cache[hostname]["ips"] for hostname in hostnames if hostname in cache}
+
+
+def read_hosts_file(hosts_file):
+    # one hostname per line, empty lines and # comments are skipped
+    try:
+        with open(hosts_file) as hosts:
+            return [line.split('#', 1)[0].strip().lower() for line in hosts if line.split('#', 1)[0].strip()]
+    except OSError as e:
+        pprint(f"ERROR: can't read hosts file {hosts_file}: {e}", error=True)
+        return []
+
+
+def add_custom_ips(custom_ips_list, ipv4_ranges, ipv6_ranges, resolved):
+    ranges = {4: ipv4_ranges, 6: ipv6_ranges}
+    for custom_ip in custom_ips_list:
+        family, start, stop = parse_range(custom_ip)
+        if family is not None:
+            ranges[family].append(start, stop)
+        elif '/' in custom_ip:
+            pprint(f"ERROR: invalid ip or range {custom_ip}")
         else:
-            pprint(f"ERROR: country database {db} missing",  error=True)
-
-
-    # continent, region, city
-    continent_filter_list = split_arg_list(argument_parser.continent)
-    region_filter_list = split_arg_list(argument_parser.region)
-    city_filter_list = split_arg_list(argument_parser.city)
-    if continent_filter_list or region_filter_list or city_filter_list:
-        db = get_valid_database_path(argument_parser, db_city)
-        if db.is_file():
-            pprint("NOTICE: searching for continent, region or city data will take some time", quiet=argument_parser.quiet)
-            hits = {
-                "continent": {},
-                "region": {},
-                "city": {},
-            }
-            for continent in continent_filter_list:
-                hits["continent"][continent] = 0
-            for region in region_filter_list:
-                hits["region"][region] = 0
-            for city in city_filter_list:
-                hits["city"][city] = 0
-
-            csv_reader = csv.reader(db.open())
-            for line in csv_reader:
-                if len(line) >= 5:
-                    start = line[0]
-                    stop = line[1]
-                    continent = line[2].lower()
-                    region = line[4].lower()
-                    city = line[5].lower()
-                    if find_one(continent, continent_filter_list):
-                        hits["continent"][continent] += 1
-                        ip_validate_and_add_to_set(start, stop, ipv4_set, ipv6_set)
-                    if find_one(region, region_filter_list):
-                        hits["region"][region] += 1
-                        ip_validate_and_add_to_set(start, stop, ipv4_set, ipv6_set)
-                    if find_one(city, city_filter_list):
-                        hits["city"][city] += 1
-                        ip_validate_and_add_to_set(start, stop, ipv4_set, ipv6_set)
-            for locality, hits_list in hits.items():
-                for sub_locality, hits in hits_list.items():
-                  if hits == 0:
-                    pprint(f"WARNING: no hit found for {locality}: {sub_locality}", error=True)
+            # hostname, resolved for all profiles at once
+            for ip in resolved.get(custom_ip, []):
+                family, ip_int = ip_to_int(ip)
+                if family is not None:
+                    ranges[family].append(ip_int, ip_int)
+
+
+def read_custom_ips_file(argument_parser, ips_file, run_size=65536):
+    # streams a plain or gzip compressed list of ip's, ip-ip ranges and networks, one per line (# and ; comments).
+    # every run_size lines are sorted and coalesced into a compact run, the runs are merged with the database
+    # ranges in merge_ranges. returns the sorted ipv4 and ipv6 runs
+    runs = {4: [], 6: []}
+    pending = {4: [], 6: []}
+    entries = 0
+    invalid = 0
+    first_invalid = None
+    try:
+        with open(ips_file, 'rb') as probe:
+            compressed = probe.read(2) == b'\x1f\x8b'
+        if compressed:
+            import gzip
+            lines = gzip.open(ips_file, 'rt', errors='replace')
         else:
-            pprint(f"ERROR city database {db} missing", error=True)
+            lines = open(ips_file, errors='replace')
+        with lines:
+            for number, line in enumerate(lines, 1):
+                text = line.split('#', 1)[0].split(';', 1)[0].strip()
+                if not text:
+                    continue
+                if '-' not in text:
+                    # feeds often have extra columns after the network
+                    text = text.split()[0]
+                family, start, stop = parse_range(text)
+                if family is None:
+                    invalid += 1
+                    if first_invalid is None:
+                        first_invalid = f"line {number}: {line.strip()}"
+                    continue
+                entries += 1
+                pending[family].append((start, stop))
+                if len(pending[family]) == run_size:
+                    runs[family].append(merge_ranges(family, [sorted(pending[family])]))
+                    pending[family] = []
+    except (OSError, EOFError) as e:
+        pprint(f"ERROR: can't read custom ips file {ips_file}: {e}", error=True)
+    for family in (4, 6):
+        if pending[family]:
+            runs[family].append(merge_ranges(family, [sorted(pending[family])]))
+    pprint(f"custom ips file {ips_file}: {entries} entries", quiet=argument_parser.quiet)
+    if invalid:
+        pprint(f"WARNING: {invalid} invalid lines in custom ips file {ips_file}, first at {first_invalid}", error=True)
+    return runs[4], runs[6]
+
+
+def custom_hostnames(custom_ips_list):
+    return [custom_ip for custom_ip in custom_ips_list
+            if '/' not in custom_ip and parse_range(custom_ip)[0] is None]
+
+
+# per database: the filter option of every dictionary encoded attribute, and how a filter option is named in warnings
+database_filters = [
+    ("asn", {"asn": "asn", "as_name": "asn"}),
+    ("country", {"country": "country"}),
+    ("city", {"continent": "continent", "region": "region", "city": "city"}),
+]
+filter_names = {"asn": "AS", "country": "country", "continent": "continent", "region": "region", "city": "city"}
+
+
+# filter expression: option=value terms combined with and, or, not and parentheses, values are comma separated
+# and can be quoted, e.g. continent=eu and not (country=de or asn="hetzner online gmbh")
+filter_value = r"""(?:"[^"]*"|'[^']*'|[^\s()"',]+)"""
+filter_token = re.compile(r"""\s*(?:(?P<parenthesis>[()])|(?P<option>[a-z_]+)\s*=\s*(?P<values>%s(?:\s*,\s*%s)*)"""
+                          r"""|(?P<keyword>and|or|not)(?![^\s()])|(?P<error>\S+))""" % (filter_value, filter_value), re.I)
+# the database filter options and ip (addresses, ranges, subnets or hostnames) can be used in terms
+filter_options = list(filter_names) + ['ip']
+
+
+def parse_filter(text):
+    # parse a filter expression into nested tuples: ('or', [...]), ('and', [...]), ('not', node) and
+    # ('term', option, values). raises ValueError with the reason when the expression is invalid
+    tokens = []
+    for match in filter_token.finditer(text):
+        if match.group('error'):
+            raise ValueError(f"unexpected {match.group('error')!r}")
+        if match.group('option'):
+            option = match.group('option').lower()
+            if option not in filter_options:
+                raise ValueError(f"unknown option {option!r}, use one of {', '.join(filter_options)}")
+            values = tuple(sorted({''.join(value).lower() for value in
+                                   re.findall(r'"([^"]*)"|\'([^\']*)\'|([^\s,"\']+)', match.group('values'))}))
+            tokens.append(('term', option, values))
+        elif match.group('parenthesis') or match.group('keyword'):
+            tokens.append((match.group('parenthesis') or match.group('keyword')).lower())
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal position
+        token = peek()
+        if token is None or (expected and token != expected):
+            raise ValueError(f"expected {expected or 'a term'} at the end" if token is None else
+                             f"expected {expected}, found {token if isinstance(token, str) else token[1]}")
+        position += 1
+        return token
+
+    def either():
+        children = [both()]
+        while peek() == 'or':
+            take('or')
+            children.append(both())
+        return children[0] if len(children) == 1 else ('or', tuple(children))
+
+    def both():
+        children = [negation()]
+        while peek() == 'and':
+            take('and')
+            children.append(negation())
+        return children[0] if len(children) == 1 else ('and', tuple(children))
+
+    def negation():
+        if peek() == 'not':
+            take('not')
+            return ('not', negation())
+        if peek() == '(':
+            take('(')
+            node = either()
+            take(')')
+            return node
+        token = take()
+        if isinstance(token, str):
+            raise ValueError(f"expected a term, found {token}")
+        return token
+
+    node = either()
+    if peek() is not None:
+        raise ValueError(f"unexpected {peek() if isinstance(peek(), str) else peek()[1]}")
+    return node
+
+
+def filter_terms(node):
+    # every term of a parsed filter expression
+    if node[0] == 'term':
+        yield node
+    elif node[0] == 'not':
+        yield from filter_terms(node[1])
+    else:
+        for child in node[1]:
+            yield from filter_terms(child)
+
+
+def evaluate_filter(node, family, term_ranges):
+    # ranges of a parsed filter expression from the sorted, disjoint ranges of its terms, with interval sweeps.
+    # and subtracts its negated children from the intersection of the others, the address space is only used for
+    # an expression that is negated as a whole
+    if node[0] == 'term':
+        return term_ranges[node][family]
+    if node[0] == 'or':
+        return merge_ranges(family, [evaluate_filter(child, family, term_ranges) for child in node[1]])
+    if node[0] == 'not':
+        children = [('not', node[1])]
+    else:
+        children = node[1]
+    included = [child for child in children if child[0] != 'not']
+    if included:
+        ranges = evaluate_filter(included[0], family, term_ranges)
+    else:
+        ranges = IpRanges(family)
+        ranges.append(0, (1 << (32 if family == 4 else 128)) - 1)
+    for child in included[1:]:
+        ranges = intersect_ranges(family, ranges, evaluate_filter(child, family, term_ranges))
+    for child in children:
+        if child[0] == 'not':
+            ranges = subtract_ranges(family, ranges, evaluate_filter(child[1], family, term_ranges))
+    return ranges
+
+
+def result_cache_path(argument_parser):
+    return Path(argument_parser.database_path, 'results')
+
+
+def result_key(source_files, profile_filters, custom_ipv4, custom_ipv6):
+    # hash of everything a generated set depends on: the identity of the used databases and custom ip list file,
+    # the normalized filters and the resolved custom ip ranges
+    identities = sorted((str(source_file), source_file.stat().st_size, source_file.stat().st_mtime_ns)
+                        for source_file in source_files)
+    key = json.dumps([result_version, identities,
+                      {option: sorted(set(values)) for option, values in profile_filters.items()},
+                      sorted(custom_ipv4), sorted(custom_ipv6)])
+    import hashlib
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def read_ranges_file(target, magic):
+    # (header, ipv4, ipv6) of a file with a json header and range columns, None when it can't be used
+    try:
+        data = target.read_bytes()
+        file_magic, header_size = column_header.unpack_from(data)
+        if file_magic != magic:
+            return None
+        header = json.loads(data[column_header.size:column_header.size + header_size])
+        if header["byteorder"] != sys.byteorder:
+            return None
+        offset = column_header.size + header_size
+        offset += -offset % 8
+        columns = []
+        for typecode, rows in [('I', header["ipv4_rows"])] * 2 + [('Q', header["ipv6_rows"])] * 4:
+            column = array(typecode)
+            column.frombytes(data[offset:offset + rows * column.itemsize])
+            if len(column) != rows:
+                return None
+            columns.append(column)
+            offset += rows * column.itemsize
+            offset += -offset % 8
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    return header, IpRanges(4, columns[:2]), IpRanges(6, columns[2:])
+
+
+def write_ranges_file(target, magic, header, ipv4, ipv6):
+    header = json.dumps(dict(header, byteorder=sys.byteorder, ipv4_rows=len(ipv4), ipv6_rows=len(ipv6))).encode()
+    with target.with_suffix(".caching").open('wb') as ranges_file:
+        ranges_file.write(column_header.pack(magic, len(header)))
+        ranges_file.write(header)
+        ranges_file.write(bytes(-ranges_file.tell() % 8))
+        for column in ipv4.columns + ipv6.columns:
+            ranges_file.write(column.tobytes())
+            ranges_file.write(bytes(-ranges_file.tell() % 8))
+    target.with_suffix(".caching").rename(target)
+
+
+def read_result(argument_parser, key):
+    # cached (ipv4, ipv6, hits) of a key, None on a miss
+    target = result_cache_path(argument_parser) / f"{key}.res"
+    stored = read_ranges_file(target, result_magic)
+    if stored is None:
+        return None
+    header, ipv4, ipv6 = stored
+    # least recently used entries are evicted first
+    os.utime(target)
+    return ipv4, ipv6, header["hits"]
+
+
+def write_result(argument_parser, key, ipv4, ipv6, hits, database_files):
+    directory = result_cache_path(argument_parser)
+    directory.mkdir(exist_ok=True)
+    write_ranges_file(directory / f"{key}.res", result_magic, {
+        "hits": hits,
+        "databases": sorted(database_file.name for database_file in database_files),
+    }, ipv4, ipv6)
+    evict_results(argument_parser)
+
+
+def delta_base(argument_parser, profile_state, inputs_key, database_files):
+    # the last result of the same filters and custom ip's when it was generated from the previous version of the
+    # databases and every replaced database has a changelog: (key, ipv4, ipv6, (changed ipv4, changed ipv6))
+    base = profile_state.get("result")
+    if not base or base[0] != inputs_key:
+        return None
+    stored = read_ranges_file(result_cache_path(argument_parser) / f"{base[1]}.res", result_magic)
+    if stored is None:
+        return None
+    header, ipv4, ipv6 = stored
+    old_databases = set(header["databases"])
+    if len(old_databases) != len(database_files):
+        return None
+    changed = ([], [])
+    for database_file in database_files:
+        if database_file.name in old_databases:
+            continue
+        database_kind = database_file.name.rsplit('-', 2)[0]
+        old_names = [name for name in old_databases if name.rsplit('-', 2)[0] == database_kind]
+        delta = read_delta(old_names[0], database_file) if len(old_names) == 1 else None
+        if delta is None:
+            return None
+        changed[0].append(delta[0])
+        changed[1].append(delta[1])
+    if not changed[0]:
+        return None
+    return base[1], ipv4, ipv6, (merge_ranges(4, changed[0]), merge_ranges(6, changed[1]))
+
+
+def evict_results(argument_parser, removed_databases=()):
+    # drop the least recently used entries above --result-cache-size, and every entry of a removed database
+    entries = []
+    for entry in result_cache_path(argument_parser).glob('*.res'):
+        try:
+            stat = entry.stat()
+            if removed_databases:
+                with entry.open('rb') as result_file:
+                    magic, header_size = column_header.unpack(result_file.read(column_header.size))
+                    header = json.loads(result_file.read(header_size))
+                if set(header["databases"]) & set(removed_databases):
+                    entry.unlink()
+                    continue
+        except (OSError, ValueError, KeyError, struct.error):
+            entry.unlink(missing_ok=True)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    size = sum(entry_size for mtime, entry_size, entry in entries)
+    for mtime, entry_size, entry in sorted(entries):
+        if size <= argument_parser.result_cache_size * 1024 * 1024:
+            break
+        entry.unlink(missing_ok=True)
+        size -= entry_size
+
 
-    return sorted(list(ipv4_set)), sorted(list(ipv6_set))
+def result_state(argument_parser):
+    # per set name the result key and cidr flag of the last written and the last applied set
+    try:
+        return json.loads((result_cache_path(argument_parser) / 'state.json').read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_result_state(argument_parser, state):
+    directory = result_cache_path(argument_parser)
+    directory.mkdir(exist_ok=True)
+    (directory / 'state.json.saving').write_text(json.dumps(state, indent=1) + "\n")
+    (directory / 'state.json.saving').rename(directory / 'state.json')
+
+
+def generate_sets(argument_parser, profiles, db_country, db_city, db_asn):
+    # every database is read once for all profiles, returns the merged ipv4 and ipv6 range buffers per profile
+    numpy_engine = argument_parser.engine != 'python' and get_numpy() is not None
+    databases = {"country": db_country, "city": db_city, "asn": db_asn}
+    ipv4_ranges = [[IpRanges(4)] for profile in profiles]
+    ipv6_ranges = [[IpRanges(6)] for profile in profiles]
+    filters = [{option: split_arg_list(getattr(profile, option)) for option in filter_names} for profile in profiles]
+    hits = [{option: {value: 0 for value in profile_filters[option]} for option in filter_names}
+            for profile_filters in filters]
+    expressions = [parse_filter(profile.filter) if profile.filter else None for profile in profiles]
+
+    # custom ip's and hostnames, the hostnames of all profiles are resolved concurrently.
+    # sorted: they are in command line order, the database selections are sorted already
+    custom_ips = [split_arg_list(profile.custom_ips) + (read_hosts_file(profile.custom_hosts_file)
+                                                        if profile.custom_hosts_file else [])
+                  for profile in profiles]
+    hostnames = [hostname for profile_custom_ips in custom_ips for hostname in custom_hostnames(profile_custom_ips)]
+    hostnames += [hostname for expression in expressions if expression for term in filter_terms(expression)
+                  if term[1] == 'ip' for hostname in custom_hostnames(term[2])]
+    resolved = resolve_hostnames(argument_parser, hostnames) if hostnames else {}
+    for profile_custom_ips, profile_ipv4, profile_ipv6 in zip(custom_ips, ipv4_ranges, ipv6_ranges):
+        add_custom_ips(profile_custom_ips, profile_ipv4[0], profile_ipv6[0], resolved)
+        profile_ipv4[0] = sorted(profile_ipv4[0])
+        profile_ipv6[0] = sorted(profile_ipv6[0])
+
+    # profiles with a cached result for the same databases, filters and custom ip's skip the database scan,
+    # profiles with a result of the previous databases only select the ranges that changed since
+    cached = [None for profile in profiles]
+    deltas = [None for profile in profiles]
+    bases = [None for profile in profiles]
+    base_keys = [None for profile in profiles]
+    state = result_state(argument_parser) if argument_parser.result_cache_size > 0 else {}
+    for number, profile in enumerate(profiles):
+        profile.result_key = None
+        profile.delta_ranges = None
+        if argument_parser.result_cache_size <= 0:
+            continue
+        expression_options = {term[1] for term in filter_terms(expressions[number])} if expressions[number] else set()
+        database_files = [get_valid_database_path(argument_parser, databases[database_name])
+                          for database_name, attribute_options in database_filters
+                          if any(filters[number][option] or option in expression_options
+                                 for option in attribute_options.values())]
+        source_files = database_files + ([Path(profile.custom_ips_file)] if profile.custom_ips_file else [])
+        if not all(source_file.is_file() for source_file in source_files):
+            continue
+        # the resolved ip's of the hostnames in an expression are part of the key, like the custom ip's
+        key_filters = dict(filters[number])
+        if expressions[number]:
+            key_filters["filter"] = [json.dumps(expressions[number])] + sorted(
+                ip for term in filter_terms(expressions[number]) if term[1] == 'ip' for value in term[2]
+                for ip in resolved.get(value, []))
+        profile.result_key = result_key(source_files, key_filters, ipv4_ranges[number][0], ipv6_ranges[number][0])
+        # the same key without the databases, links the results of one profile over the database versions
+        profile.result_inputs = result_key(source_files[len(database_files):], key_filters, ipv4_ranges[number][0],
+                                           ipv6_ranges[number][0])
+        profile.database_files = database_files
+        cached[number] = read_result(argument_parser, profile.result_key)
+        if cached[number] is not None:
+            filters[number] = {option: [] for option in filter_names}
+            expressions[number] = None
+            pprint(f"{profile.set_name}: using cached result {profile.result_key[:12]}", quiet=argument_parser.quiet)
+            continue
+        profile_state = state.get(profile.set_name, {})
+        delta = delta_base(argument_parser, profile_state, profile.result_inputs, database_files)
+        if delta is None:
+            continue
+        base_key, old_ipv4, old_ipv6, changed = delta
+        base_keys[number] = base_key
+        if profile_state.get("written") == [base_key, profile.cidr]:
+            # the set file holds the previous result, the set can be updated in the changed ranges only
+            profile.delta_ranges = changed
+        if len(changed[0]) + len(changed[1]) < delta_share * (len(old_ipv4) + len(old_ipv6)):
+            bases[number], deltas[number] = (old_ipv4, old_ipv6), changed
+            pprint(f"{profile.set_name}: updating the result of the previous databases in "
+                   f"{len(changed[0]) + len(changed[1])} changed ranges", quiet=argument_parser.quiet)
+
+    # custom ip list files, read only when there is no cached result
+    for number, profile in enumerate(profiles):
+        if profile.custom_ips_file and cached[number] is None:
+            ipv4_runs, ipv6_runs = read_custom_ips_file(argument_parser, profile.custom_ips_file)
+            ipv4_ranges[number].extend(ipv4_runs)
+            ipv6_ranges[number].extend(ipv6_runs)
+
+    # the distinct terms of the filter expressions, selected together with the filters of the profiles
+    terms = {}
+    for expression in expressions:
+        if expression:
+            for term in filter_terms(expression):
+                terms.setdefault(term, {"hits": {value: 0 for value in term[2]}, 4: [IpRanges(4)], 6: [IpRanges(6)]})
+    for term, term_state in terms.items():
+        if term[1] == 'ip':
+            add_custom_ips(list(term[2]), term_state[4][0], term_state[6][0], resolved)
+            term_state[4][0] = sorted(term_state[4][0])
+            term_state[6][0] = sorted(term_state[6][0])
+
+    # asn, country and continent, region, city: every database is read once for all profiles and terms
+    for database_name, attribute_options in database_filters:
+        database_terms = [term for term in terms if term[1] in attribute_options.values()]
+        if not database_terms and not any(profile_filters[option] for profile_filters in filters
+                                          for option in attribute_options.values()):
+            continue
+        db = get_valid_database_path(argument_parser, databases[database_name])
+        if not db.is_file():
+            pprint(f"ERROR: {database_name} database {db} missing", error=True)
+            continue
+        table = get_columns(db, database_name, quiet=argument_parser.quiet, jobs=argument_parser.jobs)
+        # profiles updating a previous result only look at the changed ranges, below
+        selections = table.select(
+            [{attribute: [] if delta else profile_filters[option] for attribute, option in attribute_options.items()}
+             for profile_filters, delta in zip(filters, deltas)]
+            + [{attribute: list(term[2]) if option == term[1] else [] for attribute, option in attribute_options.items()}
+               for term in database_terms],
+            [{attribute: profile_hits[option] for attribute, option in attribute_options.items()}
+             for profile_hits in hits]
+            + [{attribute: terms[term]["hits"] if option == term[1] else {}
+                for attribute, option in attribute_options.items()} for term in database_terms],
+            numpy_engine)
+        for number, delta in enumerate(deltas):
+            if delta is not None:
+                selections[number] = table.select_within(
+                    [{attribute: filters[number][option] for attribute, option in attribute_options.items()}],
+                    [{attribute: hits[number][option] for attribute, option in attribute_options.items()}], delta)[0]
+        run_stats.count("rows_scanned", len(table.ipv4_start) + len(table.ipv6_start_high))
+        run_stats.count("rows_matched", sum(len(ipv4) + len(ipv6) for ipv4, ipv6 in selections))
+        table.close()
+        for (selected_ipv4, selected_ipv6), profile_ipv4, profile_ipv6 in zip(selections, ipv4_ranges, ipv6_ranges):
+            profile_ipv4.append(selected_ipv4)
+            profile_ipv6.append(selected_ipv6)
+        for (selected_ipv4, selected_ipv6), term in zip(selections[len(profiles):], database_terms):
+            terms[term][4].append(selected_ipv4)
+            terms[term][6].append(selected_ipv6)
+
+    # filter expressions: the sorted, disjoint ranges of every term are combined with interval sweeps
+    term_ranges = {term: {4: merge_ranges(4, term_state[4]), 6: merge_ranges(6, term_state[6])}
+                   for term, term_state in terms.items()}
+    for expression, profile_hits, profile_ipv4, profile_ipv6 in zip(expressions, hits, ipv4_ranges, ipv6_ranges):
+        if not expression:
+            continue
+        for term in filter_terms(expression):
+            if term[1] in profile_hits:
+                for value, hit in terms[term]["hits"].items():
+                    profile_hits[term[1]][value] = profile_hits[term[1]].get(value, 0) + hit
+        profile_ipv4.append(evaluate_filter(expression, 4, term_ranges))
+        profile_ipv6.append(evaluate_filter(expression, 6, term_ranges))
+
+    results = []
+    for (profile, profile_hits, profile_ipv4, profile_ipv6, profile_cached, profile_delta, profile_base,
+         profile_base_key) in zip(profiles, hits, ipv4_ranges, ipv6_ranges, cached, deltas, bases, base_keys):
+        prefix = f"{profile.set_name}: " if len(profiles) > 1 else ""
+        if profile_cached is not None:
+            ipv4, ipv6, profile_hits = profile_cached
+        for option, option_hits in profile_hits.items():
+            for value, hit in option_hits.items():
+                if hit == 0:
+                    pprint(f"WARNING: {prefix}no hit found for {filter_names[option]}: {value}", error=True)
+        if profile_cached is None and profile_delta is not None:
+            # outside the changed ranges the previous result still holds, only the changed parts are replaced
+            ipv4 = splice_ranges(4, profile_base[0], profile_delta[0],
+                                 intersect_ranges(4, merge_ranges(4, profile_ipv4), profile_delta[0]))
+            ipv6 = splice_ranges(6, profile_base[1], profile_delta[1],
+                                 intersect_ranges(6, merge_ranges(6, profile_ipv6), profile_delta[1]))
+            pprint(f"{prefix}updated the previous {len(profile_base[0])} ipv4 and {len(profile_base[1])} ipv6 elements "
+                   f"into {len(ipv4)} and {len(ipv6)} elements", quiet=argument_parser.quiet)
+        elif profile_cached is None:
+            ipv4 = merge_ranges(4, profile_ipv4)
+            ipv6 = merge_ranges(6, profile_ipv6)
+            pprint(f"{prefix}merged {sum(map(len, profile_ipv4))} ipv4 ranges into {len(ipv4)} and "
+                   f"{sum(map(len, profile_ipv6))} ipv6 ranges into {len(ipv6)} elements", quiet=argument_parser.quiet)
+        if profile_cached is None and profile.result_key is not None:
+            write_result(argument_parser, profile.result_key, ipv4, ipv6, profile_hits, profile.database_files)
+            if profile_base_key is not None:
+                # the result of the previous databases was only kept as the base of this one
+                (result_cache_path(argument_parser) / f"{profile_base_key}.res").unlink(missing_ok=True)
+        run_stats.count("elements", len(ipv4) + len(ipv6))
+        results.append((ipv4, ipv6))
+    return results
+
+
+def element_buffer(family, ranges, cidr=False):
+    # the element ranges as written to the set file, in a range buffer
+    if not cidr and isinstance(ranges, IpRanges):
+        return ranges
+    elements = IpRanges(family)
+    for start, stop in element_ranges(family, ranges, cidr):
+        elements.append(start, stop)
+    return elements
+
+
+def write_elements(geo_nft, family, ranges, cidr=False):
+    # the elements of one set, formatted and written element_chunk elements at a time, returns the element count
+    count = 0
+    for chunk in element_chunks(format_elements(family, ranges, cidr)):
+        geo_nft.write(("\n    elements = {\n  " if not count else ",\n  ") + ",\n  ".join(chunk))
+        count += len(chunk)
+    if count:
+        geo_nft.write("\n    }")
+    return count
 
 
 def write_set(argument_parser, ipv4, ipv6):
     target_file = Path(argument_parser.target_file)
-
-    with target_file.with_suffix(".generating").open('wb') as geo_nft:
+    with target_file.with_suffix(".generating").open('w') as geo_nft:
         date_string = datetime.datetime.now().isoformat()
-        geo_nft.write(bytes(f"""# generated with pvc_geo_nft script on {date_string}
+        geo_nft.write(f"""# generated with pvc_geo_nft script on {date_string}
 # used geo ip databases from https://db-ip.com with Creative Commons Attribution 4.0 International License
 
-""", 'utf-8'))
-        geo_nft.write(bytes("""
+""")
+        geo_nft.write("""
 # load new sets
 set %set_name%_ipv4 {
     type ipv4_addr
     flags interval
-    auto-merge""".replace("%set_name%", argument_parser.set_name), 'utf-8'))
-        if ipv4:
-            geo_nft.write(bytes("""
-    elements = {
-  """, 'utf-8'))
-            geo_nft.write(bytes(",\n  ".join(ipv4), 'utf-8'))
-            geo_nft.write(bytes("""
-    }""", 'utf-8'))
-        geo_nft.write(bytes("""
+    auto-merge""".replace("%set_name%", argument_parser.set_name))
+        ipv4_elements = write_elements(geo_nft, 4, ipv4, argument_parser.cidr)
+        geo_nft.write("""
   }
 
 set %set_name%_ipv6 {
     type ipv6_addr
     flags interval
-    auto-merge""".replace("%set_name%", argument_parser.set_name), 'utf-8'))
-        if ipv6:
-            geo_nft.write(bytes("""
-    elements = {
-  """, 'utf-8'))
-            geo_nft.write(bytes(",\n  ".join(ipv6), 'utf-8'))
-            geo_nft.write(bytes("""
-     }""", 'utf-8'))
-        geo_nft.write(bytes("""
-}""", 'utf-8'))
-        target_file.with_suffix(".generating").rename(target_file)
-
-
-
-def query_line(query_ips, line):
-    line_start_ip = line[0]
-    line_end_ip = line[1]
-    try:
-        start_ip = ipaddress.IPv4Address(line_start_ip)
-        end_ip = ipaddress.IPv4Address(line_end_ip)
-    except:
+    auto-merge""".replace("%set_name%", argument_parser.set_name))
+        ipv6_elements = write_elements(geo_nft, 6, ipv6, argument_parser.cidr)
+        geo_nft.write("""
+}""")
+    target_file.with_suffix(".generating").rename(target_file)
+    run_stats.count("elements", ipv4_elements + ipv6_elements)
+    if argument_parser.cidr:
+        pprint(f"cidr cover: {ipv4_elements} ipv4 and {ipv6_elements} ipv6 elements", quiet=argument_parser.quiet)
+
+    # binary copy of the element ranges for the next incremental update, tied to this version of the set file
+    stat = target_file.stat()
+    write_ranges_file(sidecar_path(target_file), set_magic, {
+        "set_name": argument_parser.set_name,
+        "cidr": argument_parser.cidr,
+        "nft_size": stat.st_size,
+        "nft_mtime_ns": stat.st_mtime_ns,
+    }, element_buffer(4, ipv4, argument_parser.cidr), element_buffer(6, ipv6, argument_parser.cidr))
+
+
+
+def lookup_ip(indexes, family, ip):
+    # geo information of one integer ip from opened range indexes, {attribute: value}
+    info = {}
+    for database_name, index in indexes.items():
+        attributes = index.lookup(family, ip)
+        if attributes:
+            for name, value in zip(database_columns[database_name], attributes):
+                # the country is taken from the country database
+                if database_name == "city" and name == "country":
+                    continue
+                info[name] = value
+    return info
+
+
+def lookup_sorted(indexes, family, ips):
+    # geo information for numerically sorted integer ips, every search continues from the row of the previous ip
+    # so the whole list costs one forward pass over the indexes
+    rows = {database_name: 0 for database_name in indexes}
+    for ip in ips:
+        info = {}
+        for database_name, index in indexes.items():
+            row = index.find_row(family, ip, rows[database_name])
+            rows[database_name] = max(row, 0)
+            attributes = index.row_attributes(family, row, ip)
+            if attributes:
+                for name, value in zip(database_columns[database_name], attributes):
+                    if database_name == "city" and name == "country":
+                        continue
+                    info[name] = value
+        yield ip, info
+
+
+def query_file(argument_parser, db_country, db_city, db_asn):
+    # bulk lookup of the ips in a file or stdin, one ip per line, results are written sorted by ip
+    ips = {4: [], 6: []}
+    invalid = 0
+    source = sys.stdin if argument_parser.query_file == '-' else open(argument_parser.query_file)
+    with source:
+        for line in source:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            family, ip = ip_to_int(line)
+            if family is None:
+                invalid += 1
+            else:
+                ips[family].append(ip)
+
+    indexes = {}
+    for database_file, database_name in [(db_country, "country"), (db_city, "city"), (db_asn, "asn")]:
         try:
-            start_ip = ipaddress.IPv6Address(line_start_ip)
-            end_ip = ipaddress.IPv6Address(line_end_ip)
-        except:
-            return
+            csv_file = get_valid_database_path(argument_parser, database_file)
+        except IndexError:
+            pprint(f"ERROR: {database_name} database missing", error=True)
+            continue
+        indexes[database_name] = get_index(csv_file, database_name, quiet=True, jobs=argument_parser.jobs)
+
+    fields = ["ip", "country", "asn", "as_name", "continent", "region", "city"]
+    if argument_parser.query_format == 'csv':
+        import csv
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fields)
+    for family in (4, 6):
+        ips[family].sort()
+        for ip, info in lookup_sorted(indexes, family, ips[family]):
+            info["ip"] = int_to_ip(family, ip)
+            if argument_parser.query_format == 'csv':
+                writer.writerow([info.get(field, "") for field in fields])
+            else:
+                sys.stdout.write(json.dumps({field: info[field] for field in fields if field in info},
+                                            ensure_ascii=False) + "\n")
+    for index in indexes.values():
+        index.close()
+    pprint(f"{len(ips[4]) + len(ips[6])} ips looked up, {invalid} invalid lines skipped", error=True)
+
+
+class LookupServer:
+    # keeps the range indexes of the newest databases mapped and answers json lookups on a unix socket:
+    #   {"ips": ["1.1.1.1", "2a00::1"]}  ->  {"results": [{"ip": "1.1.1.1", "country": "AU", ...}, ...]}
+    #   {"stats": true}                   ->  request count and latency percentiles
+    # one request or response per line
+
+    def __init__(self, argument_parser, databases):
+        self.argument_parser = argument_parser
+        self.databases = databases
+        self.indexes = {}
+        self.loaded = {}
+        self.latencies = collections.deque(maxlen=10000)
+        self.requests = 0
+        self.queried = 0
+        self.started = time.time()
+
+    def open_newest(self):
+        # open the index of the newest database of every kind, indexes that did not change are reused
+        indexes = {}
+        loaded = {}
+        for db_name, database_name in self.databases:
+            try:
+                database_file = get_valid_database_path(self.argument_parser, db_name)
+            except IndexError:
+                continue
+            stat = database_file.stat()
+            loaded[database_name] = (str(database_file), stat.st_size, stat.st_mtime_ns)
+            if self.loaded.get(database_name) == loaded[database_name]:
+                indexes[database_name] = self.indexes[database_name]
+            else:
+                indexes[database_name] = get_index(database_file, database_name, quiet=self.argument_parser.quiet,
+                                                   jobs=self.argument_parser.jobs)
+        return indexes, loaded
+
+    def swap(self, indexes, loaded):
+        # lookups run on the event loop, so replacing the dict is atomic for every request
+        old_indexes = self.indexes
+        self.indexes = indexes
+        self.loaded = loaded
+        for database_name, index in old_indexes.items():
+            if indexes.get(database_name) is not index:
+                index.close()
+        for database_name, (database_file, size, mtime_ns) in loaded.items():
+            pprint(f"serving {database_name} from {database_file}", quiet=self.argument_parser.quiet)
+
+    def answer(self, request):
+        if not isinstance(request, dict):
+            return {"error": "request must be a json object"}
+        if request.get("stats"):
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+            return {"stats": {"requests": self.requests, "ips": self.queried, "uptime": round(time.time() - self.started),
+                              "latency_ms": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+                                             "max": percentile(1)},
+                              "databases": {name: loaded[0] for name, loaded in self.loaded.items()}}}
+        if not isinstance(request.get("ips"), list):
+            return {"error": "expected {\"ips\": [...]} or {\"stats\": true}"}
+        results = []
+        for ip in request["ips"]:
+            family, ip_int = ip_to_int(str(ip))
+            if family is None:
+                results.append({"ip": ip, "error": "not an ip"})
+            else:
+                results.append(dict(ip=ip, **lookup_ip(self.indexes, family, ip_int)))
+        self.queried += len(results)
+        return {"results": results}
+
+    async def skip_line(self, reader):
+        # drop the rest of a request line over the limit, the next request starts after its newline
+        import asyncio
+        while True:
+            try:
+                await reader.readuntil(b'\n')
+                return
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+
+    async def handle(self, reader, writer):
+        import asyncio
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                line = e.partial
+            except asyncio.LimitOverrunError:
+                line = None
+            except ConnectionError:
+                break
+            started = time.perf_counter()
+            if line is None:
+                try:
+                    await self.skip_line(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                response = {"error": "request too large"}
+            elif not line:
+                break
+            else:
+                try:
+                    response = self.answer(json.loads(line))
+                except ValueError:
+                    response = {"error": "invalid json"}
+            self.requests += 1
+            self.latencies.append(time.perf_counter() - started)
+            writer.write(json.dumps(response).encode() + b'\n')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+        writer.close()
+
+    async def reload(self):
+        # pick up the databases of the next month as soon as download() fetched them
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.argument_parser.reload_interval)
+            try:
+                indexes, loaded = await loop.run_in_executor(None, self.open_newest)
+            except (OSError, ValueError) as e:
+                pprint(f"ERROR: reloading databases: {e}", error=True)
+                continue
+            if loaded != self.loaded:
+                self.swap(indexes, loaded)
+
+    async def run(self):
+        import asyncio
+        socket_path = Path(self.argument_parser.socket)
+        socket_path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle, path=str(socket_path), limit=serve_line_limit)
+        pprint(f"listening on {socket_path}", quiet=self.argument_parser.quiet)
+        reload_task = asyncio.create_task(self.reload())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reload_task.cancel()
+            socket_path.unlink(missing_ok=True)
 
-    for query_ip in query_ips:
-        if type(query_ip) is type(start_ip):
-            if start_ip <= query_ip <= end_ip:
-                return query_ip
-    return None
+
+def serve(argument_parser, db_country, db_city, db_asn):
+    import asyncio
+    lookup_server = LookupServer(argument_parser, [(db_country, "country"), (db_city, "city"), (db_asn, "asn")])
+    lookup_server.swap(*lookup_server.open_newest())
+    asyncio.run(lookup_server.run())
 
 
 def query_host(argument_parser, db_country, db_city, db_asn):
     query_ips = set()
-    try:
-        query_ips.add(ipaddress.IPv4Address(argument_parser.query_host))
-    except ipaddress.AddressValueError:
-        try:
-            query_ips.add(ipaddress.IPv6Address(argument_parser.query_host))
-        except ipaddress.AddressValueError:
-            try:
-                for ip in socket.getaddrinfo(argument_parser.query_host, 0):
-                    if ip[1] is socket.SocketKind.SOCK_RAW and ip[0] is socket.AddressFamily.AF_INET:
-                        query_ips.add(ipaddress.IPv4Address(ip[4][0]))
-                    if ip[1] is socket.SocketKind.SOCK_RAW and ip[0] is socket.AddressFamily.AF_INET6:
-                        query_ips.add(ipaddress.IPv6Address(ip[4][0]))
-            except socket.gaierror:
-                pprint(f"sorry, query host {argument_parser.query_host} not an ip address and not resolvable via dns", error=True)
-                return
+    family, ip = ip_to_int(argument_parser.query_host)
+    if family is not None:
+        query_ips.add((family, ip))
+    else:
+        resolved = resolve_hostnames(argument_parser, [argument_parser.query_host])
+        if not resolved:
+            pprint(f"sorry, query host {argument_parser.query_host} not an ip address and not resolvable via dns", error=True)
+            return
+        for resolved_ip in resolved[argument_parser.query_host]:
+            family, ip = ip_to_int(resolved_ip)
+            if family is not None:
+                query_ips.add((family, ip))
     print("query host resolving resulted in the following ip's:")
     match = {}
     for ip in query_ips:
-        print(f"- {ip}")
+        print(f"- {int_to_ip(*ip)}")
         match[ip] = {
             "country": set(),
             "asn": set(),
@@ -415,41 +2769,50 @@ def query_host(argument_parser, db_country, db_city, db_asn):
             "region": set()
         }
 
-    print("searching databases, the csv databases are not search optimized so this can take a while...")
     for database_file, database_name in [(db_country, "country"), (db_city, "city"), (db_asn, "asn")]:
-    #for db in [(db_country, "country"), (db_asn, "asn")]:
         csv_file = Path(argument_parser.database_path, database_file)
         if csv_file.is_file():
-            csvfile = csv_file.open()
-            csv_reader = csv.reader(csvfile)
-            for line in csv_reader:
-                if len(line) > 2:
-                    ip = query_line(query_ips, line)
-                    if ip:
-                        if database_name == "country":
-                            match[ip][database_name].add(line[2])
-                        elif database_name == "asn":
-                            match[ip][database_name].add(line[2])
-                            match[ip]["as_name"].add(line[3])
-                        elif database_name == "city":
-                            match[ip]["continent"].add(line[2])
-                            match[ip]["region"].add(line[4])
-                            match[ip][database_name].add(line[5])
-            csvfile.close()
+            index = get_index(csv_file, database_name, quiet=argument_parser.quiet, jobs=argument_parser.jobs)
+            for ip in query_ips:
+                for name, value in lookup_ip({database_name: index}, *ip).items():
+                    match[ip][name].add(value)
+            index.close()
     print("\ngeoip info:")
     for ip, value in match.items():
-        print(f"\n- {ip}")
+        print(f"\n- {int_to_ip(*ip)}")
         for item, info in value.items():
             print("  -", item.ljust(10), "-" if not list(info) else "; ".join(list(info)) )
 
-def detect_nftables():
-    try:
-        r = subprocess.run([nft_path, '--version'], capture_output=True)
-        if r.returncode == 0:
-            return True
-    except FileNotFoundError:
-        pass
-    return False
+# search option: database, searched attribute and the attribute shown next to every match
+search_options = {
+    "search_asn": ("asn", "as_name", "asn"),
+    "search_city": ("city", "city", "region"),
+    "search_region": ("city", "region", "continent"),
+}
+
+
+def search_values(argument_parser, db_city, db_asn):
+    # look up filter values by part of their name in the dictionaries of the filter caches
+    databases = {"city": db_city, "asn": db_asn}
+    for option, (database_name, attribute, related) in search_options.items():
+        text = getattr(argument_parser, option)
+        if not text:
+            continue
+        db = get_valid_database_path(argument_parser, databases[database_name])
+        if not db.is_file():
+            pprint(f"ERROR: {database_name} database {db} missing", error=True)
+            continue
+        table = get_columns(db, database_name, quiet=argument_parser.quiet, jobs=argument_parser.jobs)
+        matches = table.search(attribute, text.lower(), argument_parser.search_mode, argument_parser.search_limit,
+                               related)
+        table.close()
+        print(f"{attribute.replace('_', ' ')} matching {text} ({argument_parser.search_mode}):")
+        if not matches:
+            print("- no match")
+        for value, ranges, related_values in matches:
+            shown = ", ".join(related_values[:5]) + (", ..." if len(related_values) > 5 else "")
+            print(f"- {value} ({ranges} ranges, {related.replace('_', ' ')}: {shown})")
+        print()
 
 
 def main():
@@ -459,7 +2822,7 @@ def main():
                         action='extend',
                         type=str.lower,
                         default=[],
-                        help='which autonomous system numbers or names should the set contain, exact match, case insensitive')
+                        help='which autonomous system numbers or names should the set contain, exact match or * ? [] pattern, case insensitive')
     parser.add_argument('--continent',
                         nargs='+',
                         type=str.lower,
@@ -474,88 +2837,281 @@ def main():
                         nargs='+',
                         type=str.lower,
                         default=[],
-                        help='which regions should the set contain, exact match, case insensitive')
+                        help='which regions should the set contain, exact match or * ? [] pattern, case insensitive')
     parser.add_argument('--city',
                         nargs='+',
                         type=str.lower,
                         default=[],
-                        help='which cities should the set contain, exact match, case insensitive')
+                        help='which cities should the set contain, exact match or * ? [] pattern, case insensitive')
     parser.add_argument('--custom-ips',
                         nargs='+',
                         type=str.lower,
                         default=[],
                         help='add extra ip, range, subnet or hostname from this list, working dns needed for hostnames\n'
                              'nft_geo_pvc.py --custom-ips 1.1.1.1 www.google.com 192.168.1.0/24 2a00:1450:4001:111::-2a00:1450:4001:666::')
+    parser.add_argument('--custom-ips-file',
+                        help='add the ip\'s, ranges and subnets of this file (plain text or gzip), one per line,\n'
+                             'for large block lists and threat feeds')
+    parser.add_argument('--custom-hosts-file',
+                        help='add the ip\'s of the hostnames in this file, one hostname per line')
+    parser.add_argument('--filter',
+                        help='add the ranges of a filter expression: option=value terms with and, or, not and (),\n'
+                             'options asn, continent, country, region, city and ip, values comma separated or quoted\n'
+                             'nft_geo_pvc.py --filter "continent=eu and not (country=de or asn=\'hetzner online gmbh\')"')
+    parser.add_argument('--dns-workers',
+                        type=int,
+                        default=16,
+                        help='hostnames resolved at the same time (default 16)')
+    parser.add_argument('--dns-timeout',
+                        type=float,
+                        default=5.0,
+                        help='seconds before a dns lookup is given up (default 5)')
+    parser.add_argument('--dns-ttl',
+                        type=int,
+                        default=3600,
+                        help='seconds the resolved ip\'s of a hostname are reused without a new lookup, the last\n'
+                             'known ip\'s are also used when a lookup fails (default 3600)')
+    parser.add_argument('--cidr',
+                        action='store_true',
+                        default=False,
+                        help='write the set elements as a minimal cidr cover instead of ip ranges')
+    parser.add_argument('--config',
+                        help='generate all set profiles from this json or toml file in one database pass,\n'
+                             'replaces the selection options on the command line')
     parser.add_argument('--set-name',
                         default='geo_set',
                         help='name of the nftables set, saved set wil be located under /etc/geo_nft/<set-name>.nft')
     parser.add_argument('--database-path',
                         default='/var/lib/dbip',
                         help='where to store the downloaded db\'s (default /var/lib/dbip)')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='number of processes used to scan the csv databases (default 1)')
+    parser.add_argument('--engine',
+                        choices=['auto', 'numpy', 'python'],
+                        default='auto',
+                        help='filter engine, auto uses numpy when it is installed (default auto)')
+    parser.add_argument('--download-url',
+                        default='https://download.db-ip.com/free/',
+                        help='where to download the db-ip databases from (default https://download.db-ip.com/free/)')
+    parser.add_argument('--download-timeout',
+                        type=float,
+                        default=30,
+                        help='connect and read timeout in seconds for the database downloads (default 30)')
     parser.add_argument('--query-host',
                         help='search for a match in the db-ip databases, print the information and exit')
+    parser.add_argument('--search-asn',
+                        help='search the AS names containing this text, print them with their AS numbers and exit')
+    parser.add_argument('--search-city',
+                        help='search the city names containing this text, print them with their region and exit')
+    parser.add_argument('--search-region',
+                        help='search the region names containing this text, print them with their continent and exit')
+    parser.add_argument('--search-mode',
+                        choices=['substring', 'prefix', 'fuzzy'],
+                        default='substring',
+                        help='how --search-* matches the names: substring (default), prefix or fuzzy (similar spelling)')
+    parser.add_argument('--search-limit',
+                        type=int,
+                        default=20,
+                        help='maximum number of names printed per search, 0 for all (default 20)')
+    parser.add_argument('--query-file',
+                        help='look up every ip in this file (one per line, - for stdin) in one pass, print the results and exit')
+    parser.add_argument('--query-format',
+                        choices=['csv', 'jsonl'],
+                        default='csv',
+                        help='output format for --query-file (default csv)')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        default=False,
+                        help='keep the lookup indexes loaded and answer json queries on a unix socket')
+    parser.add_argument('--socket',
+                        default='/run/nft_geo_pvc.sock',
+                        help='unix socket for --serve (default /run/nft_geo_pvc.sock)')
+    parser.add_argument('--reload-interval',
+                        type=float,
+                        default=60,
+                        help='seconds between checks for newer databases in --serve mode (default 60)')
     parser.add_argument('--apply',
                         action='store_true',
                         default=False,
                         help='apply the set after generation')
+    parser.add_argument('--incremental',
+                        choices=['file', 'live'],
+                        help='apply only the added and deleted elements instead of flushing and reloading the sets,\n'
+                             'diffed against the previously generated set file or the live set')
+    parser.add_argument('--max-diff',
+                        type=float,
+                        default=0.5,
+                        help='with --incremental, reload the full set when more than this fraction of the elements\n'
+                             'changed (default 0.5)')
+    parser.add_argument('--result-cache-size',
+                        type=int,
+                        default=64,
+                        help='size in MB of the cache of generated sets under --database-path/results, an unchanged\n'
+                             'set is not written and applied again (default 64, 0 disables the cache)')
+    parser.add_argument('--backend',
+                        choices=['nft', 'libnftables', 'mock'],
+                        default='nft',
+                        help='how sets are listed and applied: the nft binary (default), the libnftables python\n'
+                             'bindings with one json batch, or a mock that keeps the sets in a json file (testing)')
+    parser.add_argument('--mock-state',
+                        help='json file with the sets of the mock backend (default /etc/geo_nft/mock_nftables.json)')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        default=False,
+                        help='print wall time, cpu time, rows, elements and peak memory per stage')
+    parser.add_argument('--stats-json',
+                        help='write the per stage statistics as json to this file, - for stdout')
+    parser.add_argument('--stats-prometheus',
+                        help='write the per stage statistics as prometheus metrics to this file\n'
+                             '(for the node exporter textfile collector, e.g. /var/lib/node_exporter/nft_geo_pvc.prom)')
     parser.add_argument('-q', '--quiet',
                         action='store_true',
                         default=False,
                         help='make the script quiet')
     argument_parser = parser.parse_args()
+    if argument_parser.jobs < 1:
+        parser.error("--jobs needs at least 1 process")
+    if argument_parser.filter:
+        try:
+            parse_filter(argument_parser.filter)
+        except ValueError as e:
+            parser.error(f"invalid --filter: {e}")
+    if argument_parser.engine == 'numpy' and get_numpy() is None:
+        parser.error("the numpy engine needs numpy, please install with: pip3 install numpy")
 
     argument_parser.datum = time.strftime("%Y-%m")
     db_country = f"dbip-country-lite-{argument_parser.datum}.csv"
     db_city = f"dbip-city-lite-{argument_parser.datum}.csv"
     db_asn = f"dbip-asn-lite-{argument_parser.datum}.csv"
 
-    if not detect_nftables():
-        print("nftables binary not found or in path, i cannot work without it, exiting")
+    # the profiles are known before anything is downloaded, nft is only needed when a set is applied
+    lookup = argument_parser.serve or argument_parser.query_file or argument_parser.query_host
+    search = argument_parser.search_asn or argument_parser.search_city or argument_parser.search_region
+    profiles = []
+    if lookup or search:
+        pass
+    elif argument_parser.config:
+        profiles = load_profiles(argument_parser)
+    elif (argument_parser.continent == [] and argument_parser.region == [] and argument_parser.country == []
+          and argument_parser.city == [] and argument_parser.asn == [] and argument_parser.custom_ips == []
+          and not argument_parser.custom_ips_file and not argument_parser.custom_hosts_file
+          and not argument_parser.filter):
+        parser.print_help()
+        pprint("\n\nno continent, country, region, city, asn, custom ip's or filter specified\n"
+               "exiting", error=True)
+        sys.exit(1)
+    else:
+        profiles = [argument_parser]
+
+    argument_parser.nft = get_backend(argument_parser)
+    if any(profile.apply is True for profile in profiles) and not argument_parser.nft.available():
+        if argument_parser.backend == 'libnftables':
+            print("the libnftables python bindings are not installed or can't load libnftables, exiting")
+        else:
+            print("nftables binary not found or in path, i cannot work without it, exiting")
         sys.exit(1)
-    download(argument_parser, db_country, db_city, db_asn)
+    with run_stats.stage("download"):
+        download(argument_parser, db_country, db_city, db_asn)
+    with run_stats.stage("index"):
+        build_indexes(argument_parser, db_country, db_city, db_asn, filter_caches=not lookup)
     cleanup_downloads(argument_parser, db_country, db_city, db_asn)
 
-
-    if argument_parser.query_host:
+    if argument_parser.serve:
+        serve(argument_parser, db_country, db_city, db_asn)
+        sys.exit(0)
+    elif argument_parser.query_file:
+        with run_stats.stage("query"):
+            query_file(argument_parser, db_country, db_city, db_asn)
+        write_stats(argument_parser, db_country, db_city, db_asn)
+        sys.exit(0)
+    elif search:
+        with run_stats.stage("query"):
+            search_values(argument_parser, db_city, db_asn)
+        write_stats(argument_parser, db_country, db_city, db_asn)
+        sys.exit(0)
+    elif argument_parser.query_host:
         print(f"searching the databases for: {argument_parser.query_host}")
-        query_host(argument_parser, db_country, db_city, db_asn)
-        sys.exit(1)
-    elif argument_parser.continent == [] and argument_parser.region == [] and argument_parser.country == [] and argument_parser.city == [] and argument_parser.asn == [] and argument_parser.custom_ips == []:
-        parser.print_help()
-        pprint("\n\nno continent, country, region, city, asn or custom ip's specified\n"
-               "exiting", error=True)
+        with run_stats.stage("query"):
+            query_host(argument_parser, db_country, db_city, db_asn)
+        write_stats(argument_parser, db_country, db_city, db_asn)
         sys.exit(1)
 
     bp = Path(basepath)
     bp.mkdir(exist_ok=True)
 
-    argument_parser.target_file = bp / f"{argument_parser.set_name}.nft"
-    pprint(f"""generating {argument_parser.target_file} with set name {argument_parser.set_name}_ipv4 and {argument_parser.set_name}_ipv6 for:
-    * custom ip's:       {'-' if not argument_parser.custom_ips else ', '.join(argument_parser.custom_ips)}
-    * autonomous system: {'-' if not argument_parser.asn else ', '.join(split_arg_list(argument_parser.asn))}
-    * continents:        {'-' if not argument_parser.continent else ', '.join(split_arg_list(argument_parser.continent))}
-    * countries:         {'-' if not argument_parser.country else ', '.join(split_arg_list(argument_parser.country))}
-    * regions:           {'-' if not argument_parser.region else ', '.join(split_arg_list(argument_parser.region))}
-    * cities:            {'-' if not argument_parser.city else ', '.join(split_arg_list(argument_parser.city))}""",
-           quiet=argument_parser.quiet)
-
-    ipv4, ipv6 = generate_sets(argument_parser, db_country, db_city, db_asn)
-
-    if not ipv4:
-        pprint("WARNING: ipv4 set is empty", error=True)
-    if not ipv6:
-        pprint("WARNING: ipv6 set is empty", error=True)
-
-    # even if the sets are empty, write the config so that nftables includes still work
-    write_set(argument_parser, ipv4, ipv6)
-
-    if argument_parser.apply is True:
-        family, table = get_family_table(f"{argument_parser.set_name}_ipv4")
-        if family and table:
-            apply_sets(argument_parser, family, table)
-        else:
-            pprint('set not detected in live configuration, set is saved but not applied!', error=True)
-
+    for profile in profiles:
+        profile.target_file = bp / f"{profile.set_name}.nft"
+        pprint(f"""generating {profile.target_file} with set name {profile.set_name}_ipv4 and {profile.set_name}_ipv6 for:
+    * custom ip's:       {'-' if not profile.custom_ips else ', '.join(profile.custom_ips)}
+    * autonomous system: {'-' if not profile.asn else ', '.join(split_arg_list(profile.asn))}
+    * continents:        {'-' if not profile.continent else ', '.join(split_arg_list(profile.continent))}
+    * countries:         {'-' if not profile.country else ', '.join(split_arg_list(profile.country))}
+    * regions:           {'-' if not profile.region else ', '.join(split_arg_list(profile.region))}
+    * cities:            {'-' if not profile.city else ', '.join(split_arg_list(profile.city))}
+    * filter:            {profile.filter or '-'}""",
+               quiet=argument_parser.quiet)
+
+    with run_stats.stage("generate"):
+        results = generate_sets(argument_parser, profiles, db_country, db_city, db_asn)
+
+    # a set generated from the same result key is written and applied only once
+    state = result_state(argument_parser)
+    for profile in profiles:
+        profile.result_version = [profile.result_key, profile.cidr] if profile.result_key else None
+        if profile.result_key:
+            state.setdefault(profile.set_name, {})["result"] = [profile.result_inputs, profile.result_key]
+
+    previous = {}
+    with run_stats.stage("write"):
+        for profile, (ipv4, ipv6) in zip(profiles, results):
+            profile_state = state.setdefault(profile.set_name, {})
+            if (profile.result_version and profile_state.get("written") == profile.result_version
+                    and Path(profile.target_file).is_file()):
+                pprint(f"{profile.set_name}: result unchanged, keeping {profile.target_file}", quiet=argument_parser.quiet)
+                continue
+            if profile.apply is True and (argument_parser.incremental == 'file'
+                                          or (profile.delta_ranges and argument_parser.incremental != 'live')):
+                # read the elements of the last generation before the file is replaced
+                previous[profile.set_name] = read_previous_set(profile.target_file, profile.set_name)
+            if not ipv4:
+                pprint(f"WARNING: {profile.set_name}_ipv4 set is empty", error=True)
+            if not ipv6:
+                pprint(f"WARNING: {profile.set_name}_ipv6 set is empty", error=True)
+
+            # even if the sets are empty, write the config so that nftables includes still work
+            write_set(profile, ipv4, ipv6)
+            profile_state["written"] = profile.result_version
+
+    apply_profiles = []
+    for profile, (ipv4, ipv6) in zip(profiles, results):
+        if profile.apply is not True:
+            continue
+        # the live set is only compared with --incremental live, otherwise an unchanged result is not applied again
+        if (profile.result_version and state[profile.set_name].get("applied") == profile.result_version
+                and argument_parser.incremental != 'live'):
+            pprint(f"{profile.set_name}: result unchanged, set already applied", quiet=argument_parser.quiet)
+            continue
+        apply_profiles.append((profile, ipv4, ipv6))
+    if apply_profiles:
+        with run_stats.stage("apply"):
+            family_tables = get_family_tables(argument_parser)
+            targets = []
+            for profile, ipv4, ipv6 in apply_profiles:
+                if f"{profile.set_name}_ipv4" in family_tables:
+                    family, table = family_tables[f"{profile.set_name}_ipv4"]
+                    targets.append((profile, family, table, ipv4, ipv6))
+                else:
+                    pprint(f'set {profile.set_name} not detected in live configuration, set is saved but not applied!',
+                           error=True)
+            if targets and apply_sets(argument_parser, targets, previous):
+                for profile, family, table, ipv4, ipv6 in targets:
+                    state[profile.set_name]["applied"] = profile.result_version
+    if argument_parser.result_cache_size > 0:
+        save_result_state(argument_parser, state)
+
+    write_stats(argument_parser, db_country, db_city, db_asn)
     pprint('done', quiet=argument_parser.quiet)
 
 if __name__ == "__main__":